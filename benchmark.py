@@ -0,0 +1,494 @@
+"""Load simulation for the Alias bot against a local stand-in for the Telegram Bot API.
+
+Runs main.py in-process, points telebot at a fake API server on 127.0.0.1 (which records every call
+and can inject latency and 429s), and plays N chats with M players each through /setup, team joins,
+start_game and rapid right/wrong/skip clicks. Prints one JSON document; with the same arguments two
+runs are directly comparable. With --workers the same games are played against several main.py
+processes sharing a CLUSTER_DIR, optionally killing one of them mid-run.
+
+    python benchmark.py --chats 20 --players 6 --rounds 4 --round-time 5 --latency-ms 40 --error-rate 0.01
+    python benchmark.py --workers 3 --chats 12 --rounds 4 --round-time 4 --kill-after 6
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import re
+import resource
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+from urllib.parse import parse_qs, urlparse
+
+WORD_RE = re.compile(r"Слово: \*(.+?)\*")
+TEAM_RE = re.compile(r"команди \*(.+?)\*")
+
+
+class GroupPost(NamedTuple):
+    index: int
+    time: float
+    message_id: int
+    text: str
+    buttons: List[str]  # callback data of the inline keyboard
+
+
+class FakeTelegramAPI:
+    """Minimal Bot API: answers the methods main.py uses and remembers what was sent where."""
+
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, error_rate: float = 0.0, retry_after: int = 1, seed: int = 0):
+        self.latency_ms, self.jitter_ms, self.error_rate, self.retry_after = latency_ms, jitter_ms, error_rate, retry_after
+        self.rng = random.Random(seed)
+        self.calls: List[tuple] = []  # (monotonic time, method, chat_id)
+        self.throttled = 0
+        self.webhook_url = ""
+        self.words: Dict[int, tuple] = {}  # private chat -> (word shown, time it arrived, its button suffix, message id)
+        self.groups: Dict[int, List[GroupPost]] = {}  # group chat -> every message sent or edited there, in order
+        self.round_ends: Dict[int, float] = {}  # player -> when their latest "round over" message arrived
+        self._message_ids = itertools.count(1)
+        self._cond = threading.Condition()
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, like api.telegram.org
+            disable_nagle_algorithm = True  # headers and body go out in separate writes
+
+            def do_GET(self): api._handle(self)
+            def do_POST(self): api._handle(self)
+            def log_message(self, *args): pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="fake-telegram", daemon=True).start()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}/bot{{0}}/{{1}}"
+
+    def _handle(self, request: BaseHTTPRequestHandler):
+        url = urlparse(request.path)
+        method = url.path.rsplit("/", 1)[-1]
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        body = request.rfile.read(int(request.headers.get("Content-Length") or 0))
+        if request.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+            params.update({k: v[0] for k, v in parse_qs(body.decode()).items()})
+        delay = self.latency_ms + self.rng.uniform(0, self.jitter_ms)
+        if delay: time.sleep(delay / 1000)
+        status, payload = 200, {"ok": True, "result": self._result(method, params)}
+        if method not in ("getChat", "getWebhookInfo") and self.rng.random() < self.error_rate:
+            status = 429
+            payload = {"ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {self.retry_after}",
+                       "parameters": {"retry_after": self.retry_after}}
+            with self._cond: self.throttled += 1
+        else:
+            self._observe(method, params, payload["result"])
+        data = json.dumps(payload).encode()
+        request.send_response(status)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+    def _result(self, method: str, params: Dict[str, str]) -> Any:
+        if method == "getChat":
+            uid = int(params["chat_id"])
+            return {"id": uid, "type": "private", "first_name": f"Player{uid}", "username": f"player{uid}"}
+        if method in ("setWebhook", "deleteWebhook"): self.webhook_url = params.get("url", "")
+        if method in ("answerCallbackQuery", "setWebhook", "deleteWebhook"): return True
+        if method == "getWebhookInfo": return {"url": self.webhook_url, "has_custom_certificate": False, "pending_update_count": 0}
+        chat_id = int(params.get("chat_id") or 0)
+        message = {"message_id": int(params.get("message_id") or next(self._message_ids)), "date": int(time.time()),
+                   "chat": {"id": chat_id, "type": "group" if chat_id < 0 else "private"}, "text": params.get("text", "")}
+        if method in ("sendPhoto", "editMessageMedia"):
+            message["photo"] = [{"file_id": f"photo{message['message_id']}", "file_unique_id": "u", "width": 1, "height": 1}]
+        return message
+
+    def _observe(self, method: str, params: Dict[str, str], result: Any):
+        chat_id = int(params["chat_id"]) if params.get("chat_id", "").lstrip("-").isdigit() else None
+        text = params.get("text") or params.get("caption") or ""
+        if method == "editMessageMedia": text = json.loads(params.get("media", "{}")).get("caption", "")
+        match = WORD_RE.search(text)
+        buttons = [button.get("callback_data", "") for row in json.loads(params["reply_markup"])["inline_keyboard"] for button in row] if params.get("reply_markup") else []
+        suffix = ""
+        if match and buttons:
+            suffix = buttons[0][buttons[0].index(":"):] if ":" in buttons[0] else ""
+        now = time.monotonic()
+        with self._cond:
+            self.calls.append((now, method, chat_id))
+            if chat_id and chat_id > 0 and "Раунд завершено" in text:
+                self.round_ends[chat_id] = now
+                self._cond.notify_all()
+            if chat_id and chat_id < 0 and method in ("sendMessage", "editMessageText"):
+                posts = self.groups.setdefault(chat_id, [])
+                posts.append(GroupPost(len(posts), now, result["message_id"] if isinstance(result, dict) else int(params.get("message_id", 0)), text, buttons))
+                self._cond.notify_all()
+            if match and chat_id and chat_id > 0 and self.words.get(chat_id, ("",))[0] != match.group(1):
+                self.words[chat_id] = (match.group(1), now, suffix, result["message_id"])
+                self._cond.notify_all()
+
+    def group_mark(self, chat_id: int) -> int:
+        with self._cond: return len(self.groups.get(chat_id, []))
+
+    def wait_for_post(self, chat_id: int, since: int, match: Callable[[GroupPost], bool], timeout: float) -> Optional[GroupPost]:
+        """Blocks until a post at index `since` or later in `chat_id` satisfies `match`; returns it."""
+        def find() -> Optional[GroupPost]:
+            return next((post for post in self.groups.get(chat_id, [])[since:] if match(post)), None)
+        with self._cond:
+            self._cond.wait_for(lambda: find() is not None, timeout)
+            return find()
+
+    def wait_for_round_end(self, chat_id: int, after: float, timeout: float) -> Optional[float]:
+        """Blocks until player `chat_id` is told their round is over (later than `after`); returns when."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.round_ends.get(chat_id, 0.0) > after, timeout)
+            ended = self.round_ends.get(chat_id, 0.0)
+            return ended if ended > after else None
+
+    def wait_for_new_word(self, chat_id: int, old_word: Optional[str], timeout: float) -> Optional[tuple]:
+        """Blocks until `chat_id` is shown a word other than `old_word`; returns (word, arrival time, button suffix, message id)."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.words.get(chat_id, (old_word,))[0] != old_word, timeout)
+            shown = self.words.get(chat_id)
+            return shown if shown and shown[0] != old_word else None
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values: return {"count": 0}
+    ordered = sorted(values)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return {"count": len(ordered), "p50": round(pick(0.5), 2), "p90": round(pick(0.9), 2), "p99": round(pick(0.99), 2),
+            "max": round(ordered[-1], 2), "mean": round(sum(ordered) / len(ordered), 2)}
+
+
+class Simulation:
+    """Plays the chats and judges the bot only by what reaches the fake API, so it works the same whether
+    updates go to main.py in this process or over HTTP to worker processes (see --workers)."""
+
+    def __init__(self, api: FakeTelegramAPI, args: argparse.Namespace, post: Callable[[bytes], int], round_limit: int):
+        self.api, self.args, self.post, self.round_limit = api, args, post, round_limit
+        self.update_ids = itertools.count(1)
+        self.rng = random.Random(args.seed)
+        self.click_latency: List[float] = []
+        self.timer_drift: List[float] = []
+        self.rounds = self.timeouts = self.click_timeouts = 0
+        self.errors: List[str] = []
+        self._lock = threading.Lock()
+
+    def _post(self, update: Dict[str, Any]):
+        update["update_id"] = next(self.update_ids)
+        status = self.post(json.dumps(update).encode())
+        if status != 200: self.errors.append(f"webhook answered {status}")
+
+    @staticmethod
+    def _user(uid: int) -> Dict[str, Any]:
+        return {"id": uid, "is_bot": False, "first_name": f"Player{uid}", "username": f"player{uid}"}
+
+    def message(self, chat_id: int, uid: int, text: str):
+        message = {"message_id": 1, "date": int(time.time()), "chat": {"id": chat_id, "type": "group"}, "from": self._user(uid), "text": text}
+        if text.startswith("/"): message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        self._post({"message": message})
+
+    def click(self, chat_id: int, uid: int, data: str, message_id: int = 1):
+        chat_type = "group" if chat_id < 0 else "private"
+        self._post({"callback_query": {"id": str(next(self.update_ids)), "from": self._user(uid), "chat_instance": "bench", "data": data,
+                                       "message": {"message_id": message_id, "date": int(time.time()), "chat": {"id": chat_id, "type": chat_type}, "text": "-"}}})
+
+    def expect(self, chat_id: int, since: int, match: Callable[[GroupPost], bool], what: str, timeout: float = 10) -> Optional[GroupPost]:
+        post = self.api.wait_for_post(chat_id, since, match, timeout)
+        if post is None: self.errors.append(f"chat {chat_id}: {what}")
+        return post
+
+    def setup(self, chat_id: int, admin: int) -> Optional[List[str]]:
+        """Runs /setup through the wizard buttons and /start; returns the team names offered for joining."""
+        mark = self.api.group_mark(chat_id)
+        self.message(chat_id, admin, "/setup")
+        wizard = self.expect(chat_id, mark, lambda p: any(b.startswith("su:n:") for b in p.buttons), "setup wizard not shown")
+        if not wizard: return None
+        self.click(chat_id, admin, f"su:n:{self.args.teams}", wizard.message_id)
+        step = self.expect(chat_id, wizard.index + 1, lambda p: "su:a" in p.buttons, "team count not taken")
+        if not step: return None
+        self.click(chat_id, admin, "su:a", wizard.message_id)
+        step = self.expect(chat_id, step.index + 1, lambda p: p.message_id == wizard.message_id and not any(b.startswith("su:") for b in p.buttons), "setup stalled")
+        for data, prefix in (("deck_all", "deck_"), ("diff_0", "diff_")):
+            if step and data in step.buttons:
+                self.click(chat_id, admin, data, wizard.message_id)
+                step = self.expect(chat_id, step.index + 1, lambda p, prefix=prefix: p.message_id == wizard.message_id and not any(b.startswith(prefix) for b in p.buttons), f"{data} not taken")
+        if not step: return None
+        mark = self.api.group_mark(chat_id)
+        self.message(chat_id, admin, "/start")
+        board = self.expect(chat_id, mark, lambda p: any(b.startswith("team_") for b in p.buttons), "team board not shown")
+        return [b[len("team_"):] for b in board.buttons if b.startswith("team_")] if board else None
+
+    def next_team(self, chat_id: int, since: int, teams: List[str], uid: int) -> Optional[str]:
+        """Follows the end-of-round prompts (starting a new circle when asked) to the team whose turn it is."""
+        post = self.expect(chat_id, since, lambda p: "Хід переходить" in p.text or "Круг завершено" in p.text, "no next-turn prompt", 30)
+        if post and "new_circle" in post.buttons:
+            mark = self.api.group_mark(chat_id)
+            self.click(chat_id, uid, "new_circle", post.message_id)
+            post = self.expect(chat_id, mark, lambda p: "Хід знову переходить" in p.text, "new circle not started", 30)
+        match = TEAM_RE.search(post.text) if post else None
+        return next((team for team in teams if match and (match.group(1) == team or match.group(1).endswith(" " + team))), None)
+
+    def play_chat(self, index: int):
+        args = self.args
+        chat_id = -(100000 + index)
+        players = [index * 1000 + p + 1 for p in range(args.players)]
+        teams = self.setup(chat_id, players[0])
+        if not teams: return
+        team_of = {uid: teams[i % len(teams)] for i, uid in enumerate(players)}
+        for uid in players: self.click(chat_id, uid, f"team_{team_of[uid]}")
+        uid = players[0]  # anyone may start the game; the turns go by team after that
+        for round_no in range(args.rounds):
+            mark = self.api.group_mark(chat_id)
+            old = self.api.words.get(uid, (None,))[0]
+            started = time.monotonic()
+            self.click(chat_id, uid, "start_game")
+            shown = self.api.wait_for_new_word(uid, old, 10)
+            if not shown:
+                self.errors.append(f"chat {chat_id}: round did not start"); break
+            words, reached_limit = 1, False
+            for _ in range(args.clicks):
+                reached_limit = words >= self.round_limit
+                clicked = time.monotonic()
+                self.click(uid, uid, self.rng.choice(("right", "wrong", "skip")) + shown[2], shown[3])
+                if reached_limit: break
+                next_shown = self.api.wait_for_new_word(uid, shown[0], 10)
+                with self._lock:
+                    if next_shown: self.click_latency.append((next_shown[1] - clicked) * 1000)
+                    else: self.click_timeouts += 1
+                if not next_shown: break
+                shown, words = next_shown, words + 1
+                if args.think_ms: time.sleep(args.think_ms / 1000)
+            ended = self.api.wait_for_round_end(uid, started, args.round_time + 10)  # the player's copy: private chats are not congested
+            if not ended:
+                self.errors.append(f"chat {chat_id}: round never ended"); break
+            with self._lock:
+                self.rounds += 1
+                if not reached_limit:
+                    self.timeouts += 1
+                    self.timer_drift.append((ended - started - args.round_time) * 1000)
+            if round_no == args.rounds - 1: break
+            team = self.next_team(chat_id, mark, teams, uid)
+            if team is None: break
+            uid = next(u for u in players if team_of[u] == team)
+        self.click(chat_id, players[0], "finish_game")
+
+    def run(self, drained: Callable[[], bool]) -> Dict[str, Any]:
+        threads_peak = [threading.active_count()]
+        done = threading.Event()
+
+        def sample_threads():
+            while not done.wait(0.05): threads_peak[0] = max(threads_peak[0], threading.active_count())
+
+        threading.Thread(target=sample_threads, daemon=True).start()
+        started = time.monotonic()
+        workers = [threading.Thread(target=self.play_chat, args=(i,), name=f"bench-chat-{i}") for i in range(self.args.chats)]
+        for worker in workers: worker.start()
+        for worker in workers: worker.join()
+        until = time.monotonic() + 120
+        while not drained():
+            if time.monotonic() > until: self.errors.append("outbound queue did not drain"); break
+            time.sleep(0.05)
+        elapsed = time.monotonic() - started
+        done.set()
+        results_posted = sum(1 for posts in self.api.groups.values() for post in posts if "Раунд завершено" in post.text)
+        by_method: Dict[str, int] = {}
+        for _, method, _ in self.api.calls: by_method[method] = by_method.get(method, 0) + 1
+        total = len(self.api.calls)
+        return {
+            "duration_s": round(elapsed, 2),
+            "rounds": self.rounds, "timed_out_rounds": self.timeouts,
+            "click_to_next_word_ms": percentiles(self.click_latency), "click_timeouts": self.click_timeouts,
+            "timer_drift_ms": percentiles(self.timer_drift),
+            "duplicate_round_results": results_posted - self.rounds,  # a round closed by two processes at once
+            "outbound_calls": {"total": total, "per_round": round(total / self.rounds, 1) if self.rounds else None,
+                               "throttled_429": self.api.throttled, "by_method": dict(sorted(by_method.items()))},
+            "threads": {"peak": threads_peak[0], "end": threading.active_count()},
+            "errors": self.errors[:20],
+        }
+
+
+class WorkerPool:
+    """`--workers N`: N copies of main.py in their own processes, sharing one CLUSTER_DIR, state DB and history.
+
+    Each serves the webhook over HTTP on 127.0.0.1; updates are posted to them in turn, so most reach a
+    worker that does not own the chat and get forwarded. `--kill-after` SIGKILLs the last worker and
+    `--join-after` starts one more mid-run, to exercise the handoff of chats in both directions.
+    """
+
+    def __init__(self, argv: List[str], workdir: str, count: int, api_url: str):
+        self.argv, self.workdir = argv, workdir
+        self.env = dict(os.environ, CLUSTER_DIR=os.path.join(workdir, "cluster"), BENCH_API_URL=api_url)
+        self.procs: List[subprocess.Popen] = []
+        self.urls: List[str] = []
+        self._next = itertools.count()
+        self.killed: Optional[int] = None
+        self.joined: Optional[int] = None
+        for proc in [self._spawn() for _ in range(count)]: self._add(proc)
+
+    def _spawn(self) -> subprocess.Popen:
+        i = len(self.procs)
+        log = open(os.path.join(self.workdir, f"worker-{i}.log"), "w")
+        proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), *self.argv, "--serve", os.path.join(self.workdir, f"worker-{i}.port")],
+                                env=self.env, stdout=log, stderr=subprocess.STDOUT)
+        self.procs.append(proc)
+        return proc
+
+    def _add(self, proc: subprocess.Popen):
+        """Waits for a spawned worker to listen and report ready, then starts posting to it."""
+        i = self.procs.index(proc)
+        port_file = os.path.join(self.workdir, f"worker-{i}.port")
+        until = time.monotonic() + 30
+        while not os.path.exists(port_file):
+            if proc.poll() is not None or time.monotonic() > until: raise RuntimeError(f"worker {i} did not start, see {self.workdir}/worker-{i}.log")
+            time.sleep(0.05)
+        with open(port_file) as f: url = f"http://127.0.0.1:{f.read().strip()}"
+        while self._status(url + "/ready") != 200:
+            if time.monotonic() > until: raise RuntimeError(f"{url} never became ready")
+            time.sleep(0.05)
+        self.urls.append(url)
+
+    @staticmethod
+    def _status(url: str, body: Optional[bytes] = None) -> int:
+        request = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response: return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+        except OSError:
+            return 0
+
+    def post(self, path: str, body: bytes) -> int:
+        for _ in range(len(self.urls)):
+            urls = list(self.urls)
+            url = urls[next(self._next) % len(urls)]
+            status = self._status(url + path, body)
+            if status: return status
+            if url in self.urls: self.urls.remove(url)  # gone: the next worker takes it
+        return 0
+
+    def kill_last(self):
+        proc = self.procs[-1]
+        proc.send_signal(signal.SIGKILL); proc.wait()
+        self.killed = proc.pid
+
+    def join_one(self):
+        proc = self._spawn()
+        self._add(proc)
+        self.joined = proc.pid
+
+    def stop(self):
+        for proc in self.procs:
+            if proc.poll() is None: proc.terminate()
+        for proc in self.procs: proc.wait()
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chats", type=int, default=10, help="concurrent group chats")
+    parser.add_argument("--players", type=int, default=4, help="players per chat")
+    parser.add_argument("--teams", type=int, default=2, help="teams per chat (2-10)")
+    parser.add_argument("--rounds", type=int, default=3, help="rounds played in every chat")
+    parser.add_argument("--clicks", type=int, default=5, help="answers per round; below ROUND_LIMIT the round ends on the timer")
+    parser.add_argument("--round-time", type=int, default=5, help="seconds per round (overrides ROUND_TIME)")
+    parser.add_argument("--think-ms", type=float, default=0, help="pause between clicks")
+    parser.add_argument("--latency-ms", type=float, default=0, help="fake API latency per call")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="random extra latency per call")
+    parser.add_argument("--error-rate", type=float, default=0, help="share of calls answered with 429")
+    parser.add_argument("--no-rate-limits", action="store_true", help="lift the bot's own per-chat Telegram limits")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=0, help="run main.py in this many processes sharing a CLUSTER_DIR instead of in-process")
+    parser.add_argument("--kill-after", type=float, default=0, help="with --workers: SIGKILL the last worker after this many seconds")
+    parser.add_argument("--join-after", type=float, default=0, help="with --workers: start one more worker after this many seconds")
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    parser.add_argument("--serve", help=argparse.SUPPRESS)  # internal: run as one of the --workers
+    return parser.parse_args(argv)
+
+
+def configure(bot_main: Any, args: argparse.Namespace):
+    bot_main.ROUND_TIME = args.round_time
+    if args.no_rate_limits:
+        bot_main.PRIVATE_CHAT_RATE = bot_main.GROUP_CHAT_RATE = bot_main.GLOBAL_RATE = 1e9
+        bot_main.outbox._global = bot_main.TokenBucket(1e9, 1e9, time.monotonic())
+
+
+def serve(args: argparse.Namespace):
+    """`--serve PORT_FILE`: one worker process of a WorkerPool, serving the webhook until it is stopped."""
+    from telebot import apihelper
+    apihelper.API_URL = os.environ["BENCH_API_URL"]
+    import main as bot_main
+    configure(bot_main, args)
+    from werkzeug.serving import make_server
+    server = make_server("127.0.0.1", 0, bot_main.create_app(), threaded=True)
+    with open(args.serve + ".tmp", "w") as f: f.write(str(server.server_port))
+    os.replace(args.serve + ".tmp", args.serve)
+    server.serve_forever()
+
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    argv = sys.argv[1:] if argv is None else argv
+    args = parse_args(argv)
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, os.getcwd())
+    if args.serve: return serve(args)
+    workdir = tempfile.mkdtemp(prefix="alias-bench-")
+    os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+    os.environ["STATE_DB_PATH"] = os.path.join(workdir, "state.db")
+    os.environ["MEDIA_INDEX_PATH"] = os.path.join(workdir, "media_index.json")
+    os.environ["HISTORY_PATH"] = os.path.join(workdir, "history.log")
+    os.environ["WEBHOOK_LOCK_PATH"] = os.path.join(workdir, "webhook.lock")
+    os.environ.setdefault("WEBHOOK_URL", "https://bench.invalid")
+    for name in ("REPL_ID", "MEDIA_STORAGE_CHAT_ID", "CLUSTER_DIR"): os.environ.pop(name, None)
+    api = FakeTelegramAPI(args.latency_ms, args.jitter_ms, args.error_rate, seed=args.seed)
+    from telebot import apihelper
+    apihelper.API_URL = api.url
+    import main as bot_main  # in --workers mode only for WEBHOOK_PATH and ROUND_LIMIT
+    path = bot_main.WEBHOOK_PATH
+    pool = None
+    if args.workers:
+        pool = WorkerPool(argv, workdir, args.workers, api.url)
+        post = lambda body: pool.post(path, body)
+
+        def drained() -> bool:  # the workers' outboxes are out of reach, so wait for the API to go quiet
+            count = len(api.calls); time.sleep(1.0)
+            return len(api.calls) == count
+        if args.kill_after: threading.Timer(args.kill_after, pool.kill_last).start()
+        if args.join_after: threading.Timer(args.join_after, pool.join_one).start()
+    else:
+        configure(bot_main, args)
+        client = bot_main.create_app().test_client()
+        post = lambda body: client.post(path, data=body, content_type="application/json").status_code
+        drained = lambda: bot_main.outbox.stats()["queue_depth"] == 0
+        bot_main.startup.ready.wait(30)
+    try:
+        results = Simulation(api, args, post, bot_main.ROUND_LIMIT).run(drained)
+    finally:
+        if pool: pool.stop()
+    errors = results.pop("errors")
+    if pool:
+        results["workers"] = {"count": args.workers, "killed_pid": pool.killed, "joined_pid": pool.joined, "logs": workdir}
+    else:
+        results.update({
+            "startup_s": {k: round(v, 4) for k, v in bot_main.startup_phases.items()},
+            "scheduler": {k: round(v, 4) for k, v in bot_main.timers.stats().items()},
+            "outbox": bot_main.outbox.stats(), "ingest": bot_main.ingestor.stats(),
+            "memory": {"max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)},
+        })
+    results["errors"] = errors
+    report = {"config": {k: v for k, v in sorted(vars(args).items()) if k not in ("output", "serve")}, "results": results}
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f: f.write(text + "\n")
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -1,410 +1,2598 @@
 import telebot
+import bisect
+import fcntl
+import contextlib
+import functools
+import glob
+import hashlib
 import os
+import queue
+import requests
 import random
+import socket
+import struct
+import heapq
+import inspect
+import itertools
+import json
+import math
+import sqlite3
+import sys
+import tempfile
 import threading
 import time
-from telebot import types
+from array import array
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from telebot import apihelper, types
 from telebot.apihelper import ApiTelegramException
-from typing import Dict, List, Set, Optional, Any
+from typing import Callable, Dict, Iterable, List, Set, Optional, Any, Tuple
 import flask
 
+BOOT_STARTED = time.perf_counter()  # startup phases are measured from here, see Startup
+
 # --- Bot and Global Variables Initialization ---
 TOKEN = os.environ.get("BOT_TOKEN")
 if not TOKEN:
     raise ValueError("BOT_TOKEN is not set in Secrets")
 
 # CHANGED: We now read the webhook URL from a secret that you will set.
-WEBHOOK_URL = os.environ.get("WEBHOOK_URL") 
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
 WEBHOOK_PATH = f"/{TOKEN}"
 
-bot = telebot.TeleBot(TOKEN)
+apihelper.ENABLE_MIDDLEWARE = True  # lets every incoming update refresh the user cache, see remember_sender
+bot = telebot.TeleBot(TOKEN, threaded=False)  # handlers run on the UpdateIngestor workers
 app = flask.Flask(__name__)
 
-# (The rest of the global variables and core functions are unchanged)
-teams: Dict[str, List[int]] = {}
-user_teams: Dict[int, str] = {}
-teams_score: Dict[str, int] = {}
-teams_order: List[str] = []
-current_chat_id: int = 0
-game_active: bool = False
-round_in_progress: bool = False
-active_player_id: Optional[int] = None
-used_words: List[str] = []
-available_words: List[str] = []
-player_states: Dict[int, Dict[str, Any]] = {}
-played_teams: Set[str] = set()
-current_turn_index: int = 0
-group_timer_message_id: Optional[int] = None
 TEAM_EMOJIS = ['🚀', '🦅', '🔥', '⚡️', '🏆', '🎯', '🦁', '🐺', '🌟', '💎']
-team_emojis: Dict[str, str] = {}
+TEAM_NAME_PRESETS = ["Ракети", "Орли", "Вогники", "Блискавки", "Чемпіони", "Снайпери", "Леви", "Вовки", "Зірки", "Діаманти"]
 ROUND_TIME, ROUND_LIMIT = 60, 10
-try:
-    with open("words.txt", encoding="utf-8") as f:
-        all_words = [line.strip() for line in f if line.strip()]
-except FileNotFoundError:
-    all_words = ["чат", "дзвінок", "підтримка", "запит", "email"]
+# Sessions untouched for this long are dropped; MAX_SESSIONS caps memory when thousands of chats have used the bot.
+SESSION_IDLE_TTL = int(os.environ.get("SESSION_IDLE_TTL", 6 * 60 * 60))
+MAX_SESSIONS = int(os.environ.get("MAX_SESSIONS", 5000))
+WORDS_PATH, DECKS_DIR = "words.txt", "decks"
+
+# ===============================================================
+# === Metrics ===
+# ===============================================================
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", 0))  # seconds between stack samples; 0 keeps the profiler off
+
+def _escape_label(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Metric:
+    """One named metric family. Values are kept per label tuple, or computed at scrape time by `fn`
+    (which returns a number, or a dict of label tuple -> number) so hot paths pay nothing for them."""
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), fn: Optional[Callable[[], Any]] = None):
+        self.name, self.help, self.labels, self.fn = name, help, labels, fn
+        self._values: Dict[tuple, Any] = {}
+        self._lock = threading.Lock()
+
+    def _label_text(self, values: tuple, extra: str = "") -> str:
+        pairs = [f'{k}="{_escape_label(v)}"' for k, v in zip(self.labels, values)]
+        if extra: pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self) -> Iterable[str]:
+        if self.fn is not None:
+            value = self.fn()
+            items = value.items() if isinstance(value, dict) else [((), value)]
+        else:
+            with self._lock: items = list(self._values.items())
+        for labels, value in items: yield f"{self.name}{self._label_text(labels)} {float(value):g}"
+
+    def render(self) -> str:
+        return "\n".join([f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}", *self.samples()])
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        with self._lock: self._values[labels] = self._values.get(labels, 0.0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, *labels: str):
+        with self._lock: self._values[labels] = value
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, *labels: str):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None: counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]  # per-bucket counts, then the sum
+            counts[i] += 1; counts[-1] += value
+
+    def samples(self) -> Iterable[str]:
+        with self._lock: items = [(labels, list(counts)) for labels, counts in self._values.items()]
+        for labels, counts in items:
+            total = 0
+            for bound, n in zip((*self.buckets, None), counts):
+                total += n
+                le = 'le="+Inf"' if bound is None else f'le="{bound:g}"'
+                yield f"{self.name}_bucket{self._label_text(labels, le)} {total}"
+            yield f"{self.name}_sum{self._label_text(labels)} {counts[-1]:g}"
+            yield f"{self.name}_count{self._label_text(labels)} {total}"
+
+class MetricsRegistry:
+    """Prometheus text exposition for the whole process, served at /metrics."""
+    def __init__(self):
+        self._metrics: List[Metric] = []
+
+    def add(self, metric: Metric) -> Any:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labels: Tuple[str, ...] = (), fn: Optional[Callable[[], Any]] = None) -> Counter:
+        return self.add(Counter(name, help, labels, fn))
+
+    def gauge(self, name: str, help: str, labels: Tuple[str, ...] = (), fn: Optional[Callable[[], Any]] = None) -> Gauge:
+        return self.add(Gauge(name, help, labels, fn))
+
+    def histogram(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        blocks = []
+        for metric in self._metrics:
+            try: blocks.append(metric.render())
+            except Exception as e: print(f"Metric {metric.name} failed: {e!r}")
+        return "\n".join(blocks) + "\n"
+
+metrics = MetricsRegistry()
+HANDLER_SECONDS = metrics.histogram("alias_handler_seconds", "Time spent in update handlers and the webhook.", ("handler",))
+HANDLER_ERRORS = metrics.counter("alias_handler_errors_total", "Handler calls that raised.", ("handler",))
+TELEGRAM_SECONDS = metrics.histogram("alias_telegram_request_seconds", "Bot API call latency.", ("method",))
+TELEGRAM_REQUESTS = metrics.counter("alias_telegram_requests_total", "Bot API calls by method and result (ok, error, throttled).", ("method", "result"))
+TELEGRAM_ERRORS = metrics.counter("alias_telegram_errors_total", "Failed Bot API calls by method and Telegram error code.", ("method", "code"))
+TIMER_LAG_SECONDS = metrics.histogram("alias_timer_lag_seconds", "How late round timer jobs fire after their deadline.",
+                                      buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0))
+
+def instrumented(name: str) -> Callable:
+    """Records the decorated handler's latency and failures under `handler=name`."""
+    def decorate(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try: return fn(*args, **kwargs)
+            except Exception: HANDLER_ERRORS.inc(name); raise
+            finally: HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+        return wrapper
+    return decorate
+
+@contextlib.contextmanager
+def telegram_call(method: str):
+    """Wraps one Bot API request: latency, result and, on failure, the Telegram error code."""
+    started = time.perf_counter()
+    try:
+        yield
+    except ApiTelegramException as e:
+        TELEGRAM_SECONDS.observe(time.perf_counter() - started, method)
+        TELEGRAM_REQUESTS.inc(method, "throttled" if e.error_code == 429 else "error"); TELEGRAM_ERRORS.inc(method, str(e.error_code))
+        raise
+    except Exception:
+        TELEGRAM_SECONDS.observe(time.perf_counter() - started, method)
+        TELEGRAM_REQUESTS.inc(method, "error"); TELEGRAM_ERRORS.inc(method, "network")
+        raise
+    TELEGRAM_SECONDS.observe(time.perf_counter() - started, method)
+    TELEGRAM_REQUESTS.inc(method, "ok")
+
+class SamplingProfiler:
+    """Samples every thread's stack each `interval` seconds and counts them as collapsed stacks
+    (`frame;frame;frame count`), the input format of flamegraph tools. Served at /debug/profile."""
+    MAX_STACKS, MAX_DEPTH = 20000, 40
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.samples = 0
+        self._stacks: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._pid: Optional[int] = None
+
+    def start(self):
+        if not self.interval or self._pid == os.getpid(): return
+        self._pid = os.getpid()
+        threading.Thread(target=self._run, name="sampling-profiler", daemon=True).start()
+
+    def _run(self):
+        me = threading.get_ident()
+        while True:
+            time.sleep(self.interval)
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == me: continue
+                names = []
+                while frame is not None and len(names) < self.MAX_DEPTH:
+                    names.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_firstlineno})")
+                    frame = frame.f_back
+                stacks.append(";".join(reversed(names)))
+            with self._lock:
+                self.samples += 1
+                for stack in stacks:
+                    if stack in self._stacks or len(self._stacks) < self.MAX_STACKS: self._stacks[stack] = self._stacks.get(stack, 0) + 1
+
+    def report(self, reset: bool = False) -> str:
+        with self._lock:
+            stacks = sorted(self._stacks.items(), key=lambda item: -item[1])
+            if reset: self._stacks.clear(); self.samples = 0
+        return "".join(f"{stack} {count}\n" for stack, count in stacks)
+
+profiler = SamplingProfiler(PROFILE_INTERVAL)
+
+# ===============================================================
+# === Lazy Indexes ===
+# ===============================================================
+INDEX_LOADING = os.environ.get("INDEX_LOADING", "preload")  # "preload": built by the startup thread, "lazy": on first use
+startup_phases: Dict[str, float] = {}  # phase -> seconds, exported as alias_startup_seconds
+
+def timed_phase(phase: str, fn: Callable[[], Any]) -> Any:
+    started = time.perf_counter()
+    try: return fn()
+    finally: startup_phases[phase] = time.perf_counter() - started
+
+class LazyIndex:
+    """Stands in for the object `loader` builds, building it on first use or `load()`, so importing main.py reads no files."""
+    def __init__(self, name: str, loader: Callable[[], Any]):
+        self._name, self._loader, self._target, self._lock = name, loader, None, threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._target is not None
+
+    def load(self) -> Any:
+        if self._target is None:
+            with self._lock:
+                if self._target is None: self._target = timed_phase(self._name, self._loader)
+        return self._target
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._target if self._target is not None else self.load(), name)
+
+# ===============================================================
+# === Word Bank ===
+# ===============================================================
+DEFAULT_DECK = "Загальні"
+DIFFICULTY_NAMES = {1: "🟢 Легкі", 2: "🟡 Середні", 3: "🔴 Складні"}  # 0 means the deck does not tag difficulty
+RECENT_WORDS_MEMORY = 64 * 1024 * 1024  # bytes of "recently used" bitmaps kept across all chats
+
+class DeckSampler:
+    """Draws word indexes from a set of ranges without replacement: a lazy Fisher-Yates shuffle, then the words set aside by `defer`."""
+    __slots__ = ("ranges", "starts", "size", "pos", "fresh", "deferred", "swaps", "rng")
+
+    def __init__(self, ranges: List[Tuple[int, int]], seed: int):
+        self.ranges = ranges
+        self.starts: List[int] = []
+        self.size = 0
+        for start, end in ranges:
+            self.starts.append(self.size); self.size += end - start
+        self.pos = 0                   # draws made, from the shuffle or the deferred words
+        self.fresh = 0                 # draws made from the shuffle
+        self.deferred: List[int] = []  # word indexes set aside, dealt after the shuffle
+        self.swaps: Dict[int, int] = {}
+        self.rng = random.Random(seed)
+
+    @property
+    def remaining(self) -> int:
+        return self.size - self.fresh + len(self.deferred)
+
+    @property
+    def exhausted(self) -> bool:
+        """True once draws come from the deferred words."""
+        return self.fresh >= self.size
+
+    def draw(self) -> Optional[int]:
+        if self.fresh >= self.size:
+            if not self.deferred: return None
+            self.pos += 1
+            return self.deferred.pop(0)
+        j = self.rng.randrange(self.fresh, self.size)
+        picked = self.swaps.get(j, j)
+        self.swaps[j] = self.swaps.pop(self.fresh, self.fresh)
+        self.fresh += 1; self.pos += 1
+        k = bisect.bisect_right(self.starts, picked) - 1
+        return self.ranges[k][0] + picked - self.starts[k]
+
+    def defer(self, index: int):
+        self.deferred.append(index)
+
+    def seek(self, pos: int):
+        """Replays one deal that ended at `pos`: every draw before its last was set aside, as in WordBank.draw."""
+        while self.pos < pos - 1:
+            index = self.draw()
+            if index is None: return
+            self.defer(index)
+        if self.pos < pos: self.draw()
+
+    def restore(self, fresh: int, pos: int, deferred: List[int]):
+        """Loads a position saved as (fresh, pos, deferred) on a new sampler with the same seed."""
+        while self.fresh < fresh and self.draw() is not None: pass
+        self.pos, self.deferred = pos, list(deferred)
+
+class WordBank:
+    """Every deck packed into one UTF-8 buffer plus an offset array, with a bitmap per chat of recently played words."""
+    def __init__(self):
+        self._blob = bytearray()
+        self._offsets = array("I", [0])
+        self.ranges: Dict[Tuple[str, int], Tuple[int, int]] = {}
+        self.categories: List[str] = []
+        self._recent: "OrderedDict[int, list]" = OrderedDict()  # chat_id -> [bitmap, words marked]
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def add_deck(self, category: str, words: Iterable[Tuple[str, int]]):
+        by_difficulty: Dict[int, List[str]] = {}
+        for word, difficulty in words: by_difficulty.setdefault(difficulty, []).append(word)
+        if category not in self.categories: self.categories.append(category)
+        for difficulty in sorted(by_difficulty):
+            start = len(self)
+            for word in by_difficulty[difficulty]:
+                self._blob += word.encode("utf-8"); self._offsets.append(len(self._blob))
+            self.ranges[(category, difficulty)] = (start, len(self))
+
+    @staticmethod
+    def read_deck(path: str) -> Iterable[Tuple[str, int]]:
+        """Yields (word, difficulty) from a deck file: one word per line, optionally `word|1..3`, `#` comments."""
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"): continue
+                word, _, difficulty = line.partition("|")
+                yield word.strip(), int(difficulty) if difficulty.strip().isdigit() else 0
+
+    @classmethod
+    def load(cls, words_path: str = WORDS_PATH, decks_dir: str = DECKS_DIR) -> "WordBank":
+        bank = cls()
+        try: bank.add_deck(DEFAULT_DECK, cls.read_deck(words_path))
+        except FileNotFoundError: bank.add_deck(DEFAULT_DECK, ((w, 0) for w in ["чат", "дзвінок", "підтримка", "запит", "email"]))
+        for path in sorted(glob.glob(os.path.join(decks_dir, "*.txt"))):
+            bank.add_deck(os.path.splitext(os.path.basename(path))[0], cls.read_deck(path))
+        return bank
+
+    def word(self, index: int) -> str:
+        return self._blob[self._offsets[index]:self._offsets[index + 1]].decode("utf-8")
+
+    def pool(self, categories: Optional[List[str]], difficulty: int = 0) -> List[Tuple[int, int]]:
+        """Index ranges for the chosen decks (None means all) at one difficulty (0 means any)."""
+        return [r for (category, level), r in self.ranges.items()
+                if (categories is None or category in categories) and (difficulty == 0 or level == difficulty) and r[1] > r[0]]
+
+    def difficulties(self, categories: Optional[List[str]]) -> List[int]:
+        return sorted({level for (category, level), r in self.ranges.items() if level and r[1] > r[0] and (categories is None or category in categories)})
+
+    def sampler(self, categories: Optional[List[str]], difficulty: int, seed: int) -> DeckSampler:
+        return DeckSampler(self.pool(categories, difficulty), seed)
+
+    def _recent_for(self, chat_id: int) -> list:
+        entry = self._recent.get(chat_id)
+        if entry is None:
+            entry = self._recent[chat_id] = [bytearray((len(self) + 7) // 8), 0]
+            while len(self._recent) > 1 and len(self._recent) * len(entry[0]) > RECENT_WORDS_MEMORY: self._recent.popitem(last=False)
+        else:
+            self._recent.move_to_end(chat_id)
+        return entry
+
+    def start_game(self, chat_id: int, sampler: DeckSampler):
+        """Forgets a chat's recent words once they cover half of the new game's pool, so fresh ones never run out."""
+        with self._lock:
+            entry = self._recent_for(chat_id)
+            if entry[1] * 2 >= sampler.size: entry[0][:] = bytes(len(entry[0])); entry[1] = 0
+
+    def mark(self, chat_id: int, index: int):
+        with self._lock:
+            entry = self._recent_for(chat_id)
+            byte, bit = index >> 3, 1 << (index & 7)
+            if not entry[0][byte] & bit: entry[0][byte] |= bit; entry[1] += 1
+
+    def draw(self, chat_id: int, sampler: DeckSampler) -> Optional[int]:
+        """Next word for the chat. Ones it played in recent games are set aside and dealt after all the others."""
+        with self._lock:
+            bitmap = self._recent_for(chat_id)[0]
+            while True:
+                from_deferred = sampler.exhausted
+                index = sampler.draw()
+                if index is None or from_deferred or not bitmap[index >> 3] & (1 << (index & 7)): break
+                sampler.defer(index)
+        if index is not None: self.mark(chat_id, index)
+        return index
+
+word_bank: WordBank = LazyIndex("word_bank", WordBank.load)  # type: ignore[assignment]
+
+# ===============================================================
+# === 0. Per-chat Game Sessions ===
+# ===============================================================
+class PlayerState:
+    """State of the player who is currently explaining words in a round."""
+    __slots__ = ("user_id", "team", "score", "word_count", "current_word", "player_message_id", "message_type", "ends_at",
+                 "timer_active", "deadline", "timeout_job", "tick_job", "shown_at", "answers")
+    PERSISTED = ("user_id", "team", "score", "word_count", "current_word", "player_message_id", "message_type", "ends_at")
+
+    def __init__(self, user_id: int, team: str, current_word: str, ends_at: float = 0.0):
+        self.user_id = user_id
+        self.team = team
+        self.score = 0
+        self.word_count = 1
+        self.current_word = current_word
+        self.player_message_id: Optional[int] = None
+        self.message_type = "text"
+        self.ends_at = ends_at  # wall-clock end of the round, survives restarts
+        self.timer_active = True
+        self.deadline = 0.0     # the same moment on the scheduler's clock
+        self.timeout_job: Optional["TimerJob"] = None  # ends the round at the deadline
+        self.tick_job: Optional["TimerJob"] = None     # the next countdown refresh, re-armed by each tick
+        self.shown_at = time.monotonic()  # when the current word was dealt, for time-to-answer
+        self.answers: List[Tuple[float, str, int, int]] = []  # (time, word, result, ms to answer) for the history log
+
+    def stop_timer(self):
+        self.timer_active = False
+        if self.timeout_job: self.timeout_job.cancel()
+        if self.tick_job: self.tick_job.cancel()
+        self.timeout_job = self.tick_job = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.PERSISTED}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "PlayerState":
+        state = cls(data["user_id"], data["team"], data["current_word"], data["ends_at"])
+        for name in cls.PERSISTED: setattr(state, name, data[name])
+        return state
+
+class GameSession:
+    """Everything one group chat needs to play a game. Mutate only while holding `lock`; each mutation is journaled and replayable."""
+    __slots__ = ("chat_id", "lock", "last_active", "journal", "replaying", "events_since_snapshot",
+                 "teams", "user_teams", "teams_score", "teams_order", "team_emojis", "game_active", "round_in_progress",
+                 "active_player_id", "deck_categories", "deck_difficulty", "word_seed", "sampler", "player", "played_teams",
+                 "current_turn_index", "group_timer_message_id", "setup_message_id", "setup_count", "setup_names",
+                 "roster", "score_lines", "start_prompt_sent", "upcoming")
+    REPLAYABLE = frozenset(("reset", "draft_setup", "configure_teams", "choose_deck", "join", "start_game", "begin_round", "set_group_timer_message", "set_player_message",
+                            "score_answer", "next_word", "close_round", "advance_turn", "new_circle"))
+
+    def __init__(self, chat_id: int):
+        self.chat_id = chat_id
+        self.lock = threading.RLock()
+        self.last_active = time.monotonic()
+        self.journal: Optional[Callable[["GameSession", str, Dict[str, Any]], None]] = None
+        self.replaying = False
+        self.events_since_snapshot = 0
+        self.player: Optional[PlayerState] = None
+        self.roster: Optional["RosterView"] = None
+        self.reset()
+
+    def _record(self, kind: str, **data):
+        if self.journal and not self.replaying: self.journal(self, kind, data)
+
+    def replay(self, kind: str, data: Dict[str, Any]):
+        if kind not in self.REPLAYABLE: raise ValueError(f"Unknown session event '{kind}'")
+        self.replaying = True
+        try: getattr(self, kind)(**data)
+        finally: self.replaying = False
+
+    def reset(self):
+        if self.player: self.player.stop_timer()
+        if self.roster and self.roster.flush_job: self.roster.flush_job.cancel()
+        self.teams: Dict[str, List[int]] = {}
+        self.user_teams: Dict[int, str] = {}
+        self.teams_score: Dict[str, int] = {}
+        self.teams_order: List[str] = []
+        self.team_emojis: Dict[str, str] = {}
+        self.game_active = False
+        self.round_in_progress = False
+        self.active_player_id: Optional[int] = None
+        self.deck_categories: Optional[List[str]] = None
+        self.deck_difficulty = 0
+        self.word_seed = 0
+        self.sampler: Optional[DeckSampler] = None
+        self.player = None
+        self.played_teams: Set[str] = set()
+        self.current_turn_index = 0
+        self.group_timer_message_id: Optional[int] = None
+        self.setup_message_id: Optional[int] = None  # the /setup wizard message; taps on any other one are stale
+        self.setup_count = 0                         # teams asked for, 0 while the count is still being picked
+        self.setup_names: List[str] = []             # names picked so far
+        # Rendering caches, not game state: they are neither journaled nor snapshotted.
+        self.roster = None
+        self.score_lines: Dict[str, Tuple[str, int, str]] = {}
+        self.start_prompt_sent = False
+        self.upcoming: Optional[Tuple[int, int, str, tuple]] = None  # (index, sampler position, word, sampler state before it) drawn ahead of the click
+        self._record("reset")
+
+    def draft_setup(self, message_id: Optional[int], count: int = 0, names: Iterable[str] = ()):
+        """Records how far the /setup wizard in `message_id` has got, so any worker can take the next tap."""
+        self.setup_message_id, self.setup_count, self.setup_names = message_id, count, list(names)
+        self._record("draft_setup", message_id=message_id, count=count, names=self.setup_names)
+
+    def configure_teams(self, names: List[str]):
+        self.setup_count, self.setup_names = 0, []
+        for i, name in enumerate(names):
+            self.teams[name] = []; self.teams_score[name] = 0; self.teams_order.append(name)
+            self.team_emojis[name] = TEAM_EMOJIS[i % len(TEAM_EMOJIS)]
+        self._record("configure_teams", names=names)
+
+    def choose_deck(self, categories: Optional[List[str]], difficulty: int = 0):
+        self.deck_categories, self.deck_difficulty = categories, difficulty
+        self._record("choose_deck", categories=categories, difficulty=difficulty)
+
+    def join(self, user_id: int, team_name: str):
+        for members in self.teams.values():
+            if user_id in members: members.remove(user_id)
+        self.teams[team_name].append(user_id)
+        self.user_teams[user_id] = team_name
+        self._record("join", user_id=user_id, team_name=team_name)
+
+    def start_game(self, seed: int):
+        """Deals the deck and the team order from `seed`, so replaying the event deals them identically."""
+        self.sampler = word_bank.sampler(self.deck_categories, self.deck_difficulty, seed)
+        random.Random(seed).shuffle(self.teams_order)
+        self.word_seed = seed
+        self.current_turn_index = 0
+        self.game_active = True
+        if not self.replaying: word_bank.start_game(self.chat_id, self.sampler)
+        self._record("start_game", seed=seed)
+
+    def has_words(self) -> bool:
+        return self.upcoming is not None or (self.sampler is not None and self.sampler.remaining > 0)
+
+    def prefetch_word(self):
+        """Draws the next word ahead of the click that needs it; it is journaled only once used."""
+        if self.upcoming is not None or self.replaying or not self.sampler or not self.sampler.remaining: return
+        before = (self.sampler.fresh, self.sampler.pos, list(self.sampler.deferred))
+        index = word_bank.draw(self.chat_id, self.sampler)
+        if index is not None: self.upcoming = (index, self.sampler.pos, word_bank.word(index), before)
+
+    def _draw_word(self, word: Optional[int], pos: Optional[int]) -> Tuple[str, int, int]:
+        """Draws the next word, or when replaying re-applies the recorded draw; returns (word, index, sampler position)."""
+        if word is None and self.upcoming is not None:
+            word, pos, text, _ = self.upcoming
+            self.upcoming = None
+            return text, word, pos
+        if word is None:
+            word = word_bank.draw(self.chat_id, self.sampler)
+        else:
+            self.upcoming = None  # a recorded draw supersedes anything prefetched
+            self.sampler.seek(pos); word_bank.mark(self.chat_id, word)
+        return word_bank.word(word), word, self.sampler.pos
+
+    def begin_round(self, user_id: int, timer_message_id: Optional[int], ends_at: float, word: Optional[int] = None, pos: Optional[int] = None) -> PlayerState:
+        team = self.user_teams.get(user_id, "Без команди")
+        text, word, pos = self._draw_word(word, pos)
+        self.player = PlayerState(user_id, team, text, ends_at)
+        if team != "Без команди": self.played_teams.add(team)
+        self.active_player_id, self.round_in_progress, self.group_timer_message_id = user_id, True, timer_message_id
+        self._record("begin_round", user_id=user_id, timer_message_id=timer_message_id, ends_at=ends_at, word=word, pos=pos)
+        return self.player
+
+    def set_group_timer_message(self, message_id: int):
+        self.group_timer_message_id = message_id
+        self._record("set_group_timer_message", message_id=message_id)
+
+    def set_player_message(self, message_id: Optional[int], message_type: str):
+        state = self.player
+        if not state or (state.player_message_id, state.message_type) == (message_id, message_type): return
+        state.player_message_id, state.message_type = message_id, message_type
+        self._record("set_player_message", message_id=message_id, message_type=message_type)
+
+    def score_answer(self, correct: bool):
+        if not correct or not self.player: return
+        self.player.score += 1
+        self._record("score_answer", correct=True)
+
+    def next_word(self, word: Optional[int] = None, pos: Optional[int] = None) -> str:
+        state = self.player
+        state.current_word, word, pos = self._draw_word(word, pos)
+        state.word_count += 1
+        state.shown_at = time.monotonic()
+        self._record("next_word", word=word, pos=pos)
+        return state.current_word
+
+    def close_round(self) -> Optional[PlayerState]:
+        """Ends the running round and credits its score to the player's team."""
+        state = self.player
+        if state:
+            state.stop_timer()
+            if state.team: self.teams_score[state.team] = self.teams_score.get(state.team, 0) + state.score
+        self.round_in_progress, self.active_player_id, self.player, self.group_timer_message_id = False, None, None, None
+        self._record("close_round")
+        return state
+
+    def advance_turn(self) -> bool:
+        """Passes the turn to the next team; returns True when every team has played this circle."""
+        circle_complete = self.current_turn_index + 1 >= len(self.teams_order)
+        self.current_turn_index = 0 if circle_complete else self.current_turn_index + 1
+        self._record("advance_turn")
+        return circle_complete
+
+    def new_circle(self):
+        self.current_turn_index = 0
+        self._record("new_circle")
+
+    def to_dict(self) -> Dict[str, Any]:
+        # A prefetched word is not journaled yet, so the deck is saved as it was before that draw.
+        fresh, pos, deferred = self.upcoming[3] if self.upcoming else (self.sampler.fresh, self.sampler.pos, self.sampler.deferred) if self.sampler else (0, 0, [])
+        return {"teams": self.teams, "user_teams": list(self.user_teams.items()), "teams_score": self.teams_score,
+                "teams_order": self.teams_order, "team_emojis": self.team_emojis, "game_active": self.game_active,
+                "round_in_progress": self.round_in_progress, "active_player_id": self.active_player_id,
+                "deck_categories": self.deck_categories, "deck_difficulty": self.deck_difficulty, "word_seed": self.word_seed,
+                "word_pos": pos, "word_fresh": fresh, "word_deferred": deferred, "played_teams": sorted(self.played_teams),
+                "current_turn_index": self.current_turn_index, "group_timer_message_id": self.group_timer_message_id,
+                "setup": [self.setup_message_id, self.setup_count, self.setup_names],
+                "player": self.player.to_dict() if self.player else None}
+
+    def restore(self, data: Dict[str, Any]):
+        """Loads a `to_dict` snapshot; the deck position is re-dealt from the seed rather than stored."""
+        self.teams, self.teams_score, self.teams_order = data["teams"], data["teams_score"], data["teams_order"]
+        self.user_teams = {int(uid): team for uid, team in data["user_teams"]}
+        self.team_emojis, self.played_teams = data["team_emojis"], set(data["played_teams"])
+        self.game_active, self.round_in_progress = data["game_active"], data["round_in_progress"]
+        self.active_player_id, self.current_turn_index = data["active_player_id"], data["current_turn_index"]
+        self.group_timer_message_id = data["group_timer_message_id"]
+        self.deck_categories, self.deck_difficulty = data["deck_categories"], data["deck_difficulty"]
+        self.word_seed = data["word_seed"]
+        self.setup_message_id, self.setup_count, self.setup_names = data.get("setup", (None, 0, []))  # absent in older snapshots
+        if self.game_active:
+            self.sampler = word_bank.sampler(self.deck_categories, self.deck_difficulty, self.word_seed)
+            pos = data["word_pos"]
+            self.sampler.restore(data.get("word_fresh", pos), pos, data.get("word_deferred", []))  # older snapshots never deferred
+        self.player = PlayerState.from_dict(data["player"]) if data["player"] else None
+
+class SessionRegistry:
+    """Maps chat ids to their GameSession and active players to the chat they are playing in."""
+    def __init__(self, idle_ttl: float = SESSION_IDLE_TTL, max_sessions: int = MAX_SESSIONS):
+        self.idle_ttl = idle_ttl
+        self.max_sessions = max_sessions
+        self._sessions: "OrderedDict[int, GameSession]" = OrderedDict()
+        self._players: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+        self.on_create: Optional[Callable[[GameSession], None]] = None  # loads persisted state into a new session
+        self.on_player_change: Optional[Callable[[int, Optional[int]], None]] = None  # (user_id, chat_id or None) on bind/unbind
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def get(self, chat_id: int, create: bool = True) -> Optional[GameSession]:
+        now = time.monotonic()
+        with self._lock:
+            session = self._sessions.get(chat_id)
+            created = session is None
+            if created:
+                if not create: return None
+                session = self._sessions[chat_id] = GameSession(chat_id)
+                session.lock.acquire()  # anyone else asking for this chat waits until it is loaded
+            else:
+                self._sessions.move_to_end(chat_id)
+            session.last_active = now
+            if len(self._sessions) > self.max_sessions or now - self._last_sweep > 60:
+                self._evict_locked(now)
+        if created:
+            try:
+                if self.on_create: self.on_create(session)
+            except BaseException:
+                with self._lock:
+                    if self._sessions.get(chat_id) is session: self._remove_locked(chat_id, session)
+                raise
+            finally:
+                session.lock.release()
+        return session
+
+    def for_player(self, user_id: int) -> Optional[GameSession]:
+        """Returns the session in which `user_id` is the active player (their private-chat callbacks land here)."""
+        with self._lock:
+            chat_id = self._players.get(user_id)
+        return self.get(chat_id, create=False) if chat_id is not None else None
+
+    def bind_player(self, user_id: int, chat_id: int) -> bool:
+        """Marks `user_id` as the active player in `chat_id`; refuses if they are mid-round in another chat."""
+        with self._lock:
+            other = self._players.get(user_id)
+            if other is not None and other != chat_id:
+                session = self._sessions.get(other)
+                if session is not None and session.round_in_progress and session.active_player_id == user_id:
+                    return False
+            self._players[user_id] = chat_id
+        if other != chat_id and self.on_player_change: self.on_player_change(user_id, chat_id)
+        return True
+
+    def chat_of_player(self, user_id: int) -> Optional[int]:
+        with self._lock: return self._players.get(user_id)
+
+    def unbind_player(self, user_id: int, chat_id: int):
+        with self._lock:
+            if self._players.get(user_id) != chat_id: return
+            del self._players[user_id]
+        if self.on_player_change: self.on_player_change(user_id, None)
+
+    def chat_ids(self) -> List[int]:
+        with self._lock: return list(self._sessions)
+
+    def discard(self, chat_id: int) -> bool:
+        """Forgets a chat now handled by another process: its timers stop and nothing is written for it."""
+        with self._lock: session = self._sessions.get(chat_id)
+        if session is None: return False
+        with session.lock, self._lock:
+            if self._sessions.get(chat_id) is not session: return False
+            self._remove_locked(chat_id, session)
+        return True
+
+    def counts(self) -> Tuple[int, int, int]:
+        """(sessions in memory, games in progress, rounds in progress) for monitoring; read without session locks."""
+        with self._lock: current = list(self._sessions.values())
+        return len(current), sum(1 for s in current if s.game_active), sum(1 for s in current if s.round_in_progress)
+
+    def evict_idle(self) -> int:
+        with self._lock:
+            return self._evict_locked(time.monotonic())
+
+    def _evict_locked(self, now: float) -> int:
+        self._last_sweep = now
+        evicted = 0
+        for chat_id, session in list(self._sessions.items()):
+            over_cap = len(self._sessions) > self.max_sessions
+            if not over_cap and now - session.last_active < self.idle_ttl: break  # LRU order: the rest are fresher
+            if session.round_in_progress and now - session.last_active < self.idle_ttl: continue
+            if not session.lock.acquire(blocking=False): continue
+            try: self._remove_locked(chat_id, session)
+            finally: session.lock.release()
+            evicted += 1
+        return evicted
+
+    def _remove_locked(self, chat_id: int, session: GameSession):
+        del self._sessions[chat_id]
+        self._players = {uid: cid for uid, cid in self._players.items() if cid != chat_id}
+        if session.player: session.player.stop_timer()
+        session.player = None
+        session.journal = None
+
+sessions = SessionRegistry()
+
+# ===============================================================
+# === Round Timer Scheduler ===
+# ===============================================================
+class TimerJob:
+    __slots__ = ("when", "seq", "fn", "args", "cancelled")
+
+    def __init__(self, when: float, seq: int, fn: Callable, args: tuple):
+        self.when, self.seq, self.fn, self.args, self.cancelled = when, seq, fn, args, False
+
+    def __lt__(self, other: "TimerJob") -> bool:
+        return (self.when, self.seq) < (other.when, other.seq)
+
+    def cancel(self):
+        self.cancelled = True
+
+class TimerScheduler:
+    """One heap of round deadlines, fired by a single thread onto a small executor (inline by `run_pending()` when not `threaded`)."""
+    def __init__(self, clock: Callable[[], float] = time.monotonic, workers: int = 8, threaded: bool = True):
+        self.clock = clock
+        self.workers = workers
+        self.threaded = threaded
+        self._heap: List[TimerJob] = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pid: Optional[int] = None
+        self._start_lock = threading.Lock()
+        self.fired = 0
+        self.last_lag = self.max_lag = self.total_lag = 0.0
+
+    def _ensure_thread(self):
+        # Per process, like UpdateIngestor: a forked child keeps the inherited deadlines but needs its own threads.
+        if not self.threaded or self._pid == os.getpid(): return
+        with self._start_lock:
+            if self._pid == os.getpid(): return
+            if self._pid is not None: self._cond = threading.Condition()
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="round-timer")
+            threading.Thread(target=self._run, name="round-timer-scheduler", daemon=True).start()
+            self._pid = os.getpid()
+
+    def call_at(self, when: float, fn: Callable, *args) -> TimerJob:
+        job = TimerJob(when, next(self._seq), fn, args)
+        self._ensure_thread()
+        with self._cond:
+            heapq.heappush(self._heap, job)
+            if self._heap[0] is job: self._cond.notify()
+        return job
+
+    def call_later(self, delay: float, fn: Callable, *args) -> TimerJob:
+        return self.call_at(self.clock() + delay, fn, *args)
+
+    def _pop_due(self, now: float) -> List[TimerJob]:
+        due = []
+        while self._heap and (self._heap[0].cancelled or self._heap[0].when <= now):
+            job = heapq.heappop(self._heap)
+            if not job.cancelled: due.append(job)
+        return due
+
+    def _dispatch(self, jobs: List[TimerJob], now: float):
+        for job in jobs:
+            lag = max(0.0, now - job.when)
+            self.fired += 1; self.last_lag = lag; self.total_lag += lag
+            if lag > self.max_lag: self.max_lag = lag
+            TIMER_LAG_SECONDS.observe(lag)
+            if self._executor: self._executor.submit(self._call, job)
+            else: self._call(job)
+
+    @staticmethod
+    def _call(job: TimerJob):
+        if job.cancelled: return
+        try: job.fn(*job.args)
+        except Exception as e: print(f"Timer job error: {e!r}")
+
+    def run_pending(self) -> int:
+        """Fires every job whose deadline has passed; returns how many ran."""
+        now = self.clock()
+        with self._cond: due = self._pop_due(now)
+        self._dispatch(due, now)
+        return len(due)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = self.clock()
+                    due = self._pop_due(now)
+                    if due: break
+                    self._cond.wait(self._heap[0].when - now if self._heap else None)
+            self._dispatch(due, now)
+
+    def stats(self) -> Dict[str, float]:
+        self._ensure_thread()
+        with self._cond: active = sum(1 for job in self._heap if not job.cancelled)
+        return {"active_timers": active, "fired": self.fired, "last_lag": self.last_lag, "max_lag": self.max_lag,
+                "avg_lag": self.total_lag / self.fired if self.fired else 0.0}
+
+timers = TimerScheduler()
+
+# ===============================================================
+# === Outbound Telegram Queue ===
+# ===============================================================
+PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW = 0, 1, 2
+# Telegram allows roughly 30 messages/s overall, ~1/s per private chat and 20/min per group.
+GLOBAL_RATE, PRIVATE_CHAT_RATE, GROUP_CHAT_RATE = 30.0, 1.0, 20 / 60
+PRIVATE_CHAT_BURST, GROUP_CHAT_BURST = 5, 20
+LOW_PRIORITY_RESERVE = 2   # tokens per chat that cosmetic updates may not spend
+GROUP_LOW_PRIORITY_RESERVE = 8  # in groups: a round's end (timer edit, result, score, next-turn prompt) plus the next round's start
+LOW_PRIORITY_TTL = 3.0     # cosmetic updates older than this are dropped instead of sent late
+OUTBOX_MAX_QUEUE = int(os.environ.get("OUTBOX_MAX_QUEUE", 10000))
+OUTBOX_WORKERS = int(os.environ.get("OUTBOX_WORKERS", 8))
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "stamp")
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate, self.capacity, self.tokens, self.stamp = rate, capacity, capacity, now
+
+    def wait_time(self, now: float, reserve: float = 0) -> float:
+        """Seconds until one token can be spent while keeping `reserve` tokens back."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate); self.stamp = now
+        missing = 1 + reserve - self.tokens
+        return missing / self.rate if missing > 0 else 0.0
+
+    def is_full(self, now: float) -> bool:
+        return self.tokens + (now - self.stamp) * self.rate >= self.capacity
+
+class OutboundJob:
+    __slots__ = ("priority", "seq", "method", "args", "kwargs", "chat_id", "coalesce_key", "future", "created", "cancelled")
+
+    def __init__(self, priority: int, seq: int, method: str, args: tuple, kwargs: dict, chat_id: Optional[int], coalesce_key: Optional[tuple], future: Future, created: float):
+        self.priority, self.seq, self.method, self.args, self.kwargs = priority, seq, method, args, kwargs
+        self.chat_id, self.coalesce_key, self.future, self.created, self.cancelled = chat_id, coalesce_key, future, created, False
+
+    def __lt__(self, other: "OutboundJob") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+class Outbox:
+    """Every call to the Bot API goes through here: by priority, in order within a chat, under Telegram's rate limits."""
+    def __init__(self, bot: telebot.TeleBot, workers: int = OUTBOX_WORKERS, clock: Callable[[], float] = time.monotonic):
+        self.bot = bot
+        self.workers = workers
+        self.clock = clock
+        self._ready: List[OutboundJob] = []
+        self._pending_edits: Dict[tuple, OutboundJob] = {}
+        self._buckets: Dict[int, TokenBucket] = {}
+        self._global = TokenBucket(GLOBAL_RATE, GLOBAL_RATE, clock())
+        self._paused_until: Dict[Optional[int], float] = {}
+        self._busy: Set[int] = set()
+        self._signatures: Dict[str, inspect.Signature] = {}
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._pid: Optional[int] = None
+        self._start_lock = threading.Lock()
+        self.sent = self.failed = self.retried = self.coalesced = self.dropped = 0
+
+    def _bind(self, method: str, args: tuple, kwargs: dict) -> Dict[str, Any]:
+        sig = self._signatures.get(method)
+        if sig is None: sig = self._signatures[method] = inspect.signature(getattr(self.bot, method))
+        return sig.bind_partial(*args, **kwargs).arguments
+
+    def submit(self, method: str, *args, priority: int = PRIORITY_NORMAL, coalesce: bool = False, **kwargs) -> Future:
+        bound = self._bind(method, args, kwargs)
+        chat_id = bound.get("chat_id")
+        key = (method, chat_id, bound.get("message_id")) if coalesce else None
+        now = self.clock()
+        self._ensure_workers()
+        with self._cond:
+            old = self._pending_edits.get(key) if key else None
+            if old is not None:
+                old.cancelled = True; self.coalesced += 1
+                job = OutboundJob(min(priority, old.priority), old.seq, method, args, kwargs, chat_id, key, old.future, now)
+            else:
+                if priority == PRIORITY_LOW and len(self._ready) >= OUTBOX_MAX_QUEUE:
+                    self.dropped += 1
+                    future: Future = Future(); future.set_result(None); return future
+                job = OutboundJob(priority, next(self._seq), method, args, kwargs, chat_id, key, Future(), now)
+            if key: self._pending_edits[key] = job
+            heapq.heappush(self._ready, job)
+            self._cond.notify()
+        return job.future
+
+    def discard(self, method: str, chat_id: int, message_id: int):
+        """Drops a still-queued coalescing edit of that message, e.g. a countdown made stale by newer content."""
+        self._ensure_workers()
+        with self._cond:
+            job = self._pending_edits.get((method, chat_id, message_id))
+            if job is not None: job.cancelled = True; self._drop(job)
+
+    def call(self, method: str, *args, **kwargs) -> Any:
+        """Queues the call and waits for its result, re-raising any Telegram error."""
+        return self.submit(method, *args, **kwargs).result()
+
+    def send(self, method: str, *args, **kwargs) -> Future:
+        """Fire-and-forget variant of `call`; failures are logged."""
+        future = self.submit(method, *args, **kwargs)
+        future.add_done_callback(lambda f, m=method: self._log_failure(m, f))
+        return future
+
+    @staticmethod
+    def _log_failure(method: str, future: Future):
+        e = future.exception()
+        if e is None or (isinstance(e, ApiTelegramException) and 'message is not modified' in e.description): return
+        print(f"Outbound {method} error: {e}")
+
+    def _ensure_workers(self):
+        # Per process, like UpdateIngestor. A forked child keeps the queued jobs; the ones its parent had in
+        # flight are lost with the parent's threads, so their chats must not stay busy.
+        if self._pid == os.getpid(): return
+        with self._start_lock:
+            if self._pid == os.getpid(): return
+            if self._pid is not None: self._cond, self._busy = threading.Condition(), set()
+            for i in range(self.workers): threading.Thread(target=self._work, name=f"outbox-{i}", daemon=True).start()
+            self._pid = os.getpid()
+
+    def _bucket(self, chat_id: int, now: float) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if len(self._buckets) > 10000:
+                self._buckets = {cid: b for cid, b in self._buckets.items() if not b.is_full(now)}
+            if chat_id < 0: bucket = TokenBucket(GROUP_CHAT_RATE, GROUP_CHAT_BURST, now)
+            else: bucket = TokenBucket(PRIVATE_CHAT_RATE, PRIVATE_CHAT_BURST, now)
+            self._buckets[chat_id] = bucket
+        return bucket
+
+    def _next_job(self, now: float) -> tuple:
+        """Pops the best job that may run now, or returns (None, seconds_to_wait)."""
+        held: List[OutboundJob] = []
+        wait: Optional[float] = None
+        job = None
+        if len(self._paused_until) > 1000:
+            self._paused_until = {cid: until for cid, until in self._paused_until.items() if until > now}
+        global_wait = max(self._paused_until.get(None, 0.0) - now, 0.0)
+        while self._ready:
+            candidate = heapq.heappop(self._ready)
+            if candidate.cancelled: continue
+            if candidate.priority == PRIORITY_LOW and now - candidate.created > LOW_PRIORITY_TTL:
+                self._drop(candidate); continue
+            chat_id = candidate.chat_id
+            if chat_id is None:  # callback answers and lookups bypass chat limits
+                if global_wait: held.append(candidate); wait = global_wait if wait is None else min(wait, global_wait); continue
+                job = candidate; break
+            if chat_id in self._busy: held.append(candidate); continue
+            reserve = 0 if candidate.priority != PRIORITY_LOW else GROUP_LOW_PRIORITY_RESERVE if chat_id < 0 else LOW_PRIORITY_RESERVE
+            delay = max(global_wait, self._paused_until.get(chat_id, 0.0) - now,
+                        self._bucket(chat_id, now).wait_time(now, reserve), self._global.wait_time(now))
+            if delay > 0:
+                held.append(candidate); wait = delay if wait is None else min(wait, delay); continue
+            self._buckets[chat_id].tokens -= 1; self._global.tokens -= 1
+            job = candidate; break
+        for other in held: heapq.heappush(self._ready, other)
+        if job is not None:
+            if job.coalesce_key and self._pending_edits.get(job.coalesce_key) is job: del self._pending_edits[job.coalesce_key]
+            if job.chat_id is not None: self._busy.add(job.chat_id)
+        return job, wait
+
+    def _drop(self, job: OutboundJob):
+        if job.coalesce_key and self._pending_edits.get(job.coalesce_key) is job: del self._pending_edits[job.coalesce_key]
+        self.dropped += 1
+        job.future.set_result(None)
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while True:
+                    job, wait = self._next_job(self.clock())
+                    if job is not None: break
+                    self._cond.wait(wait)
+            retry_after = None
+            try:
+                with telegram_call(job.method): result = getattr(self.bot, job.method)(*job.args, **job.kwargs)
+            except ApiTelegramException as e:
+                if e.error_code == 429:
+                    retry_after = float((e.result_json.get("parameters") or {}).get("retry_after", 1))
+                else:
+                    self.failed += 1; job.future.set_exception(e)
+            except Exception as e:
+                self.failed += 1; job.future.set_exception(e)
+            else:
+                self.sent += 1; job.future.set_result(result)
+            with self._cond:
+                if job.chat_id is not None: self._busy.discard(job.chat_id)
+                if retry_after is not None:
+                    self.retried += 1
+                    self._paused_until[job.chat_id] = self.clock() + retry_after
+                    if job.coalesce_key and job.coalesce_key in self._pending_edits: self._drop(job)  # a newer edit is already queued
+                    else:
+                        if job.coalesce_key: self._pending_edits[job.coalesce_key] = job
+                        heapq.heappush(self._ready, job)
+                self._cond.notify_all()
+
+    def stats(self) -> Dict[str, int]:
+        self._ensure_workers()
+        with self._cond:
+            depth = [0, 0, 0]
+            for job in self._ready:
+                if not job.cancelled: depth[job.priority] += 1
+        return {"queue_depth": sum(depth), "queue_high": depth[PRIORITY_HIGH], "queue_normal": depth[PRIORITY_NORMAL],
+                "queue_low": depth[PRIORITY_LOW], "sent": self.sent, "failed": self.failed, "retried": self.retried,
+                "coalesced": self.coalesced, "dropped": self.dropped}
+
+# One keep-alive connection pool shared by every thread that talks to the Bot API; telebot would otherwise
+# open a session per thread and recycle it (with a fresh TLS handshake) every ten minutes.
+http_session = requests.Session()
+for prefix in ("https://", "http://"):
+    http_session.mount(prefix, requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=OUTBOX_WORKERS + 8))
+apihelper.session, apihelper.SESSION_TIME_TO_LIVE = http_session, None
+
+outbox = Outbox(bot)
+
+# ===============================================================
+# === User Profile Cache ===
+# ===============================================================
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 50000))
+USER_CACHE_TTL, USER_CACHE_MISS_TTL = 24 * 60 * 60, 10 * 60
+
+class UserCache:
+    """Bounded LRU+TTL map from user id to the name we mention them by (username, else first name)."""
+    def __init__(self, bot: telebot.TeleBot, maxsize: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL):
+        self.bot = bot
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._lookups: Optional[ThreadPoolExecutor] = None
+        self._pid: Optional[int] = None
+        self.hits = self.misses = 0
+
+    def _put(self, user_id: int, name: Optional[str], ttl: float):
+        with self._lock:
+            self._entries[user_id] = (name, time.monotonic() + ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize: self._entries.popitem(last=False)
+
+    def remember(self, user: Optional[types.User]):
+        if user is not None: self._put(user.id, user.username or user.first_name, self.ttl)
+
+    def _cached(self, user_id: int) -> tuple:
+        entry = self._entries.get(user_id)
+        if entry is None or entry[1] < time.monotonic(): return False, None
+        self._entries.move_to_end(user_id)
+        return True, entry[0]
+
+    def _fetch(self, user_id: int) -> Optional[str]:
+        try:
+            with telegram_call("get_chat"): chat = self.bot.get_chat(user_id)
+            name, ttl = chat.username or chat.first_name, self.ttl
+        except ApiTelegramException:
+            name, ttl = None, USER_CACHE_MISS_TTL
+        self._put(user_id, name, ttl)
+        return name
+
+    def names(self, user_ids: List[int]) -> Dict[int, Optional[str]]:
+        """Resolves many users at once; only cache misses hit the API, each at most once and in parallel."""
+        result: Dict[int, Optional[str]] = {}
+        missing: List[int] = []
+        with self._lock:
+            for uid in user_ids:
+                if uid in result or uid in missing: continue
+                found, name = self._cached(uid)
+                if found: result[uid] = name; self.hits += 1
+                else: missing.append(uid); self.misses += 1
+        if not missing: return result
+        if self._pid != os.getpid():  # per process, like UpdateIngestor; an unused pool has no threads, so a lost race costs nothing
+            self._lookups, self._pid = ThreadPoolExecutor(max_workers=4, thread_name_prefix="user-lookup"), os.getpid()
+        for uid, name in zip(missing, self._lookups.map(self._fetch, missing)): result[uid] = name
+        return result
+
+    def name(self, user_id: int) -> Optional[str]:
+        return self.names([user_id])[user_id]
+
+users = UserCache(bot)
+
+# ===============================================================
+# === Word Image Cache ===
+# ===============================================================
+IMAGES_DIR = "images"
+MEDIA_INDEX_PATH = os.environ.get("MEDIA_INDEX_PATH", "media_index.json")
+MEDIA_STORAGE_CHAT_ID = os.environ.get("MEDIA_STORAGE_CHAT_ID")  # optional chat the pre-warm uploads every image to
+MEDIA_RESCAN_INTERVAL = 60
+
+class MediaCache:
+    """Remembers the Telegram file_id of every word image so each picture is uploaded only once."""
+    def __init__(self, images_dir: str = IMAGES_DIR, index_path: str = MEDIA_INDEX_PATH):
+        self.images_dir = images_dir
+        self.index_path = index_path
+        self._file_ids: Dict[str, tuple] = {}
+        self._images: Dict[str, tuple] = {}
+        self._scanned_at: Optional[float] = None
+        self._lock = threading.Lock()
+        self.uploads = self.reuses = 0
+        try:
+            with open(index_path, encoding="utf-8") as f:
+                self._file_ids = {word: tuple(entry) for word, entry in json.load(f).items()}
+        except (OSError, ValueError):
+            pass
+
+    def _scan(self):
+        images: Dict[str, tuple] = {}
+        try:
+            with os.scandir(self.images_dir) as entries:
+                for entry in entries:
+                    if entry.name.endswith(".png") and entry.is_file():
+                        stat = entry.stat()
+                        images[entry.name[:-4]] = (entry.path, stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            pass
+        self._images, self._scanned_at = images, time.monotonic()
+
+    def _image(self, word: str) -> Optional[tuple]:
+        with self._lock:
+            if self._scanned_at is None or time.monotonic() - self._scanned_at > MEDIA_RESCAN_INTERVAL: self._scan()
+            return self._images.get(word.lower())
+
+    def image_path(self, word: str) -> Optional[str]:
+        image = self._image(word)
+        return image[0] if image else None
+
+    def file_id(self, word: str) -> Optional[str]:
+        image, entry = self._image(word), self._file_ids.get(word.lower())
+        if not image or not entry or tuple(entry[1:]) != image[1:]: return None
+        self.reuses += 1
+        return entry[0]
+
+    def store(self, word: str, msg: Any, save: bool = True):
+        """Records the file_id Telegram assigned to the photo in `msg`."""
+        image = self._image(word)
+        if not image or not isinstance(msg, types.Message) or not msg.photo: return
+        with self._lock:
+            self._file_ids[word.lower()] = (msg.photo[-1].file_id,) + image[1:]
+            self.uploads += 1
+        if save: self.save()
+
+    def forget(self, word: str):
+        with self._lock: self._file_ids.pop(word.lower(), None)
+
+    def save(self):
+        with self._lock: data = dict(self._file_ids)
+        tmp_path = self.index_path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f: json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            print(f"Could not save media index: {e}")
+
+    def prewarm(self, storage_chat_id: int):
+        """Uploads every image that has no valid file_id yet to `storage_chat_id`."""
+        self._image("")
+        uploaded = 0
+        for word, (path, _, _) in sorted(self._images.items()):
+            if self.file_id(word): continue
+            try:
+                with open(path, "rb") as img:
+                    msg = outbox.call("send_photo", storage_chat_id, img, disable_notification=True)
+                self.store(word, msg, save=False); uploaded += 1
+            except (OSError, ApiTelegramException) as e:
+                print(f"Pre-warm failed for '{word}': {e}")
+            if uploaded and uploaded % 20 == 0: self.save()
+        if uploaded: self.save()
+        print(f"🖼️ Media pre-warm finished: {uploaded} images uploaded.")
+
+def _load_media() -> "MediaCache":
+    cache = MediaCache()
+    cache._image("")  # scans the image folder
+    return cache
+media: MediaCache = LazyIndex("media_index", _load_media)  # type: ignore[assignment]
 
 # ===============================================================
-# === 1. Core Game Logic Functions (No Changes Here) ===
+# === Game State Store ===
 # ===============================================================
-def _get_team_display_name(team_name: str) -> str:
-    emoji = team_emojis.get(team_name, "🔹")
+STATE_DB_PATH = os.environ.get("STATE_DB_PATH", "alias_state.db")  # empty disables persistence
+SNAPSHOT_EVERY = 200        # events per chat before they are folded into a snapshot
+GROUP_COMMIT_WINDOW = 0.02  # seconds the writer waits to batch more events into one transaction
+STATE_RETENTION = float(os.environ.get("STATE_RETENTION_DAYS", 30)) * 24 * 60 * 60  # a chat idle this long loses its stored state; 0 keeps it
+STATE_PURGE_INTERVAL = 60 * 60
+ROUND_EVENTS = {"begin_round": 1, "close_round": 0}  # events that start or end a round, for chats.round
+
+class GameStore:
+    """Durable journal of session events in SQLite, folded into a snapshot every SNAPSHOT_EVERY events; `open()` creates it."""
+    def __init__(self, path: str):
+        self.path = path
+        self._queue: queue.Queue = queue.Queue()
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+        self._opened = False
+        self._next_purge = 0.0
+        self.appended = self.commits = self.purged = 0
+
+    def open(self):
+        """Creates the database and its schema once per process."""
+        if self._opened: return
+        with self._lock:
+            if self._opened: return
+            db = self._connect()
+            try:
+                db.execute("CREATE TABLE IF NOT EXISTS snapshots (chat_id INTEGER PRIMARY KEY, state TEXT NOT NULL)")
+                db.execute("CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY, chat_id INTEGER NOT NULL, kind TEXT NOT NULL, data TEXT NOT NULL)")
+                db.execute("CREATE INDEX IF NOT EXISTS events_chat ON events (chat_id, id)")
+                if not db.execute("SELECT 1 FROM sqlite_master WHERE name = 'chats'").fetchone():
+                    db.execute("CREATE TABLE chats (chat_id INTEGER PRIMARY KEY, round INTEGER NOT NULL, updated REAL NOT NULL)")
+                    self._index_chats(db)
+                db.commit()
+            finally:
+                db.close()
+            self._opened = True
+
+    @staticmethod
+    def _index_chats(db: sqlite3.Connection):
+        """Fills `chats` for a database written before it existed, by reading each chat's rounds once."""
+        rounds = {chat_id: int(bool(json.loads(state).get("round_in_progress"))) for chat_id, state in db.execute("SELECT chat_id, state FROM snapshots")}
+        for chat_id, kind in db.execute("SELECT chat_id, kind FROM events ORDER BY id"): rounds[chat_id] = ROUND_EVENTS.get(kind, rounds.get(chat_id, 0))
+        db.executemany("INSERT INTO chats (chat_id, round, updated) VALUES (?, ?, ?)", [(chat_id, r, time.time()) for chat_id, r in rounds.items()])
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.path, timeout=30)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def _put(self, op: Any):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    threading.Thread(target=self._write_loop, name="state-writer", daemon=True).start()
+                    self._pid = os.getpid()
+        self._queue.put(op)
+
+    def record(self, session: GameSession, kind: str, data: Dict[str, Any]):
+        """GameSession journal hook; called with the session lock held, right after the mutation."""
+        chat_id = session.chat_id
+        if kind == "reset":
+            session.events_since_snapshot = 0
+            self._put(("clear", chat_id))
+        elif session.events_since_snapshot + 1 >= SNAPSHOT_EVERY:
+            session.events_since_snapshot = 0
+            self._put(("snapshot", chat_id, json.dumps(session.to_dict(), ensure_ascii=False, separators=(",", ":")), int(session.round_in_progress)))
+        else:
+            session.events_since_snapshot += 1
+            self._put(("event", chat_id, kind, json.dumps(data, ensure_ascii=False, separators=(",", ":")), ROUND_EVENTS.get(kind)))
+        self.appended += 1
+
+    def _write_loop(self):
+        self.open()
+        db = self._connect()
+        while True:
+            ops = [self._queue.get()]
+            until = time.monotonic() + GROUP_COMMIT_WINDOW
+            while len(ops) < 1000 and not isinstance(ops[-1], threading.Event):
+                try: ops.append(self._queue.get(timeout=max(0.0, until - time.monotonic())))
+                except queue.Empty: break
+            waiters = []
+            try:
+                now = time.time()
+                with db:
+                    for op in ops:
+                        if isinstance(op, threading.Event): waiters.append(op); continue
+                        if op[0] == "event": db.execute("INSERT INTO events (chat_id, kind, data) VALUES (?, ?, ?)", op[1:4])
+                        else:
+                            db.execute("DELETE FROM events WHERE chat_id = ?", (op[1],))
+                            if op[0] == "snapshot": db.execute("INSERT OR REPLACE INTO snapshots (chat_id, state) VALUES (?, ?)", op[1:3])
+                            else: db.execute("DELETE FROM snapshots WHERE chat_id = ?", (op[1],))
+                        if op[0] == "clear": db.execute("DELETE FROM chats WHERE chat_id = ?", (op[1],)); continue
+                        db.execute("INSERT OR IGNORE INTO chats (chat_id, round, updated) VALUES (?, 0, ?)", (op[1], now))
+                        db.execute("UPDATE chats SET updated = ?, round = COALESCE(?, round) WHERE chat_id = ?", (now, op[-1], op[1]))
+                    if STATE_RETENTION and now >= self._next_purge: self._purge(db, now - STATE_RETENTION); self._next_purge = now + STATE_PURGE_INTERVAL
+                self.commits += 1
+            except sqlite3.Error as e:
+                print(f"State store write failed: {e}")
+            for waiter in waiters: waiter.set()
+
+    def _purge(self, db: sqlite3.Connection, cutoff: float):
+        """Deletes every row of the chats last written before `cutoff`: abandoned setups, joins and games."""
+        stale = "SELECT chat_id FROM chats WHERE updated < ?"
+        db.execute(f"DELETE FROM events WHERE chat_id IN ({stale})", (cutoff,))
+        db.execute(f"DELETE FROM snapshots WHERE chat_id IN ({stale})", (cutoff,))
+        self.purged += db.execute("DELETE FROM chats WHERE updated < ?", (cutoff,)).rowcount
+
+    def flush(self, timeout: float = 5.0):
+        """Blocks until everything recorded so far is committed."""
+        if self._pid != os.getpid(): return
+        done = threading.Event()
+        self._put(done)
+        done.wait(timeout)
+
+    def load(self, chat_id: int) -> Optional[tuple]:
+        """Returns (snapshot or None, [(kind, data), ...]) for a chat, or None if nothing is stored."""
+        self.flush()
+        self.open()
+        db = self._connect()
+        try:
+            row = db.execute("SELECT state FROM snapshots WHERE chat_id = ?", (chat_id,)).fetchone()
+            events = db.execute("SELECT kind, data FROM events WHERE chat_id = ? ORDER BY id", (chat_id,)).fetchall()
+        finally:
+            db.close()
+        if row is None and not events: return None
+        return (json.loads(row[0]) if row else None), [(kind, json.loads(data)) for kind, data in events]
+
+    def active_chat_ids(self) -> List[int]:
+        """Chats whose stored game has a round in progress; the rest are loaded when their next update arrives."""
+        self.open()
+        db = self._connect()
+        try: return [row[0] for row in db.execute("SELECT chat_id FROM chats WHERE round = 1")]
+        finally: db.close()
+
+store = GameStore(STATE_DB_PATH) if STATE_DB_PATH else None
+
+# ===============================================================
+# === Game History ===
+# ===============================================================
+HISTORY_PATH = os.environ.get("HISTORY_PATH", "alias_history.log")  # empty disables the history and its commands
+HISTORY_MAX_BYTES = int(os.environ.get("HISTORY_MAX_BYTES", 64 << 20))  # the log is compacted beyond this size
+HISTORY_KEEP_BYTES = 4 << 20         # most recent raw records kept by compaction; older ones live on in the aggregates
+HISTORY_CHECKPOINT_BYTES = 2 << 20   # log growth between checkpoints, which bounds the replay on startup
+HISTORY_MAINTAIN_INTERVAL = 60
+RESULT_WRONG, RESULT_RIGHT, RESULT_SKIP, RESULT_TIMEOUT = 0, 1, 2, 3
+RESULT_CODES = {"wrong": RESULT_WRONG, "right": RESULT_RIGHT, "skip": RESULT_SKIP}
+ROUND_FIRST = 0x80  # set on the result byte of a round's first word
+MIN_WORD_SHOWS = 5  # words seen fewer times are left out of the hardest/easiest lists
+
+class GameHistory:
+    """Append-only binary log of every dealt word's outcome, and the aggregates folded from it."""
+    RECORD = struct.Struct("<BdqqBIBB")
+    HEADER = struct.Struct("<8sI")  # file magic, generation
+    MAGIC, FILE_MAGIC = 0xA7, b"ALIASLOG"
+
+    def __init__(self, path: str):
+        self.path, self.checkpoint_path, self.lock_path = path, path + ".ckpt", path + ".lock"
+        self._lock = threading.RLock()
+        self._pid: Optional[int] = None
+        self._reset_aggregates()
+        self._inode: Optional[int] = None
+        self._generation = 0
+        self._offset = 0
+        self._checkpointed = 0
+        self._word_lists: Optional[tuple] = None
+        self._word_lists_at = 0.0
+
+    def _reset_aggregates(self):
+        self.chats: Dict[int, List[int]] = {}                 # chat -> [rounds, words, guessed, ms spent on guessed words]
+        self.players: Dict[int, Dict[int, List[int]]] = {}    # chat -> player -> [points, words, rounds]
+        self.teams: Dict[int, Dict[str, List[int]]] = {}      # chat -> team -> [points, words]
+        self.words: Dict[str, List[int]] = {}                 # word -> [shown, guessed, ms spent on guesses]
+
+    @contextlib.contextmanager
+    def _file_lock(self, mode: int):
+        with open(self.lock_path, "a") as f:
+            fcntl.flock(f, mode)
+            yield
+
+    def _ensure_started(self):
+        if self._pid == os.getpid(): return
+        with self._lock:
+            if self._pid == os.getpid(): return
+            if not os.path.exists(self.path):
+                with self._file_lock(fcntl.LOCK_EX):
+                    if not os.path.exists(self.path):
+                        with open(self.path, "ab") as f: f.write(self.HEADER.pack(self.FILE_MAGIC, 0))
+            threading.Thread(target=self._maintain_loop, name="history-maintain", daemon=True).start()
+            self._pid = os.getpid()
+
+    # --- Writing ---
+    def record_round(self, chat_id: int, team: str, user_id: int, answers: List[Tuple[float, str, int, int]]):
+        if not answers: return
+        self._ensure_started()
+        team_bytes = team.encode("utf-8")[:255]
+        parts = []
+        for i, (ts, word, result, ms) in enumerate(answers):
+            word_bytes = word.encode("utf-8")[:255]
+            parts.append(self.RECORD.pack(self.MAGIC, ts, chat_id, user_id, result | (ROUND_FIRST if i == 0 else 0), ms, len(team_bytes), len(word_bytes)))
+            parts += (team_bytes, word_bytes)
+        try:
+            with self._file_lock(fcntl.LOCK_SH), open(self.path, "ab") as f: f.write(b"".join(parts))
+        except OSError as e:
+            print(f"History write failed: {e}")
+
+    # --- Folding ---
+    def _fold(self, ts: float, chat_id: int, user_id: int, result: int, ms: int, team: str, word: str):
+        right = result & ~ROUND_FIRST == RESULT_RIGHT
+        first = 1 if result & ROUND_FIRST else 0
+        chat = self.chats.setdefault(chat_id, [0, 0, 0, 0])
+        chat[0] += first; chat[1] += 1
+        player = self.players.setdefault(chat_id, {}).setdefault(user_id, [0, 0, 0])
+        player[1] += 1; player[2] += first
+        team_totals = self.teams.setdefault(chat_id, {}).setdefault(team, [0, 0])
+        team_totals[1] += 1
+        totals = self.words.setdefault(word, [0, 0, 0])
+        totals[0] += 1
+        if right:
+            chat[2] += 1; chat[3] += ms; player[0] += 1; team_totals[0] += 1; totals[1] += 1; totals[2] += ms
+
+    def _header(self, data: bytes, pos: int) -> Optional[tuple]:
+        """The record header at `pos`, or None if the bytes there cannot start one."""
+        if pos + self.RECORD.size > len(data) or data[pos] != self.MAGIC: return None
+        header = self.RECORD.unpack_from(data, pos)
+        return header if 1e9 < header[1] < 1e10 and header[4] & ~ROUND_FIRST <= RESULT_TIMEOUT else None
+
+    def _fold_bytes(self, data: bytes) -> int:
+        """Folds every complete record in `data`; returns how many bytes that consumed."""
+        pos, size = 0, self.RECORD.size
+        while pos + size <= len(data):
+            header = self._header(data, pos)
+            if header is None: pos += 1; continue  # the tail of a torn write: resynchronise on the next record
+            _, ts, chat_id, user_id, result, ms, team_len, word_len = header
+            end = pos + size + team_len + word_len
+            if end > len(data): break
+            # A torn record's lengths reach into the record after it. A header cannot occur inside UTF-8 text
+            # (its timestamp's top byte 0x41 would follow a lead byte), so one found there starts the next record.
+            inner = data.find(self.MAGIC, pos + size, end)
+            while inner != -1 and self._header(data, inner) is None: inner = data.find(self.MAGIC, inner + 1, end)
+            if inner != -1: pos = inner; continue
+            team = data[pos + size:pos + size + team_len].decode("utf-8", "replace")
+            self._fold(ts, chat_id, user_id, result, ms, team, data[end - word_len:end].decode("utf-8", "replace"))
+            pos = end
+        return pos
+
+    def _load(self):
+        """(Re)builds the aggregates from the checkpoint, then positions the reader after what it covers."""
+        self._reset_aggregates()
+        self._word_lists = None
+        with open(self.path, "rb") as f:
+            self._inode = os.fstat(f.fileno()).st_ino
+            _, self._generation = self.HEADER.unpack(f.read(self.HEADER.size))
+            size = os.fstat(f.fileno()).st_size
+        self._offset = self.HEADER.size
+        try:
+            with open(self.checkpoint_path, encoding="utf-8") as f: saved = json.load(f)
+        except FileNotFoundError:
+            saved = None
+        if saved is None or saved["generation"] < self._generation: return  # nothing usable: fold the whole log
+        self.chats = {int(k): v for k, v in saved["chats"].items()}
+        for chat_id, user_id, *totals in saved["players"]: self.players.setdefault(chat_id, {})[user_id] = totals
+        for chat_id, team, *totals in saved["teams"]: self.teams.setdefault(chat_id, {})[team] = totals
+        self.words = saved["words"]
+        # A newer checkpoint means compaction stopped between its two renames; everything in this log is folded.
+        self._offset = saved["covered"] if saved["generation"] == self._generation else size
+        self._checkpointed = self._offset
+
+    def catch_up(self):
+        """Folds whatever was appended since the last call, reloading after another process compacted."""
+        self._ensure_started()
+        with self._lock:
+            for _ in range(3):
+                try:
+                    if os.stat(self.path).st_ino != self._inode: self._load()
+                    with open(self.path, "rb") as f:
+                        if os.fstat(f.fileno()).st_ino != self._inode: continue  # replaced between the two looks
+                        f.seek(self._offset)
+                        data = f.read()
+                except FileNotFoundError:
+                    return
+                if data: self._offset += self._fold_bytes(data); self._word_lists = None
+                return
+
+    # --- Checkpoints and compaction ---
+    def _snapshot(self, covered: int, generation: int) -> str:
+        return json.dumps({"generation": generation, "covered": covered, "chats": self.chats,
+                           "players": [[c, u, *t] for c, members in self.players.items() for u, t in members.items()],
+                           "teams": [[c, team, *t] for c, teams in self.teams.items() for team, t in teams.items()],
+                           "words": self.words}, ensure_ascii=False, separators=(",", ":"))
+
+    def _write_checkpoint(self, text: str):
+        tmp = f"{self.checkpoint_path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f: f.write(text)
+        os.replace(tmp, self.checkpoint_path)
+
+    def maintain(self):
+        """Checkpoints after enough growth and compacts an oversized log; safe to run in every process."""
+        self.catch_up()
+        size = os.path.getsize(self.path)
+        if size <= HISTORY_MAX_BYTES and self._offset - self._checkpointed < HISTORY_CHECKPOINT_BYTES: return
+        with self._file_lock(fcntl.LOCK_EX), self._lock:
+            self.catch_up()  # appenders are now shut out, so this reaches the end of the log
+            if os.path.getsize(self.path) <= HISTORY_MAX_BYTES:
+                self._write_checkpoint(self._snapshot(self._offset, self._generation))
+                self._checkpointed = self._offset
+                return
+            with open(self.path, "rb") as f: data = f.read()
+            cut = self.HEADER.size
+            while cut + self.RECORD.size <= len(data) and cut < self._offset - HISTORY_KEEP_BYTES:
+                magic, _, _, _, _, _, team_len, word_len = self.RECORD.unpack_from(data, cut)
+                cut += self.RECORD.size + team_len + word_len if magic == self.MAGIC else 1
+            generation = self._generation + 1
+            covered = self.HEADER.size + self._offset - cut
+            self._write_checkpoint(self._snapshot(covered, generation))  # first, so a crash before the log swap loses nothing
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f: f.write(self.HEADER.pack(self.FILE_MAGIC, generation) + data[cut:])
+            os.replace(tmp, self.path)
+            self._load()
+
+    def _maintain_loop(self):
+        while True:
+            time.sleep(HISTORY_MAINTAIN_INTERVAL)
+            try: self.maintain()
+            except Exception as e: print(f"History maintenance failed: {e!r}")
+
+    # --- Queries: constant in the size of the history ---
+    def leaderboard(self, chat_id: int, limit: int = 10) -> Tuple[List[Tuple[int, List[int]]], List[Tuple[str, List[int]]]]:
+        self.catch_up()
+        with self._lock:
+            players = heapq.nlargest(limit, self.players.get(chat_id, {}).items(), key=lambda item: (item[1][0], -item[1][1]))
+            teams = sorted(self.teams.get(chat_id, {}).items(), key=lambda item: -item[1][0])[:limit]
+            return [(uid, list(t)) for uid, t in players], [(team, list(t)) for team, t in teams]
+
+    def chat_stats(self, chat_id: int) -> List[int]:
+        self.catch_up()
+        with self._lock: return list(self.chats.get(chat_id, [0, 0, 0, 0]))
+
+    def word_extremes(self, limit: int = 5) -> Tuple[List[Tuple[str, List[int]]], List[Tuple[str, List[int]]]]:
+        """(hardest, easiest) words by guess rate, from words shown at least MIN_WORD_SHOWS times; refreshed at most once a minute."""
+        self.catch_up()
+        with self._lock:
+            if self._word_lists is None or time.monotonic() - self._word_lists_at > HISTORY_MAINTAIN_INTERVAL:
+                rated = [(totals[1] / totals[0], word, list(totals)) for word, totals in self.words.items() if totals[0] >= MIN_WORD_SHOWS]
+                hardest = heapq.nsmallest(limit, rated, key=lambda item: (item[0], -item[2][0]))  # ties: the most often seen first
+                easiest = heapq.nlargest(limit, rated, key=lambda item: (item[0], item[2][0]))
+                self._word_lists = ([(w, t) for _, w, t in hardest], [(w, t) for _, w, t in easiest])
+                self._word_lists_at = time.monotonic()
+            return self._word_lists
+
+history = GameHistory(HISTORY_PATH) if HISTORY_PATH else None
+
+# ===============================================================
+# === 1. Core Game Logic Functions ===
+# ===============================================================
+def _get_team_display_name(session: GameSession, team_name: str) -> str:
+    emoji = session.team_emojis.get(team_name, "🔹")
     return f"{emoji} {team_name}"
-def _create_word_buttons() -> types.InlineKeyboardMarkup:
+
+# --- Group message rendering ---
+ROSTER_DEBOUNCE = 0.7  # seconds; a join rush turns into at most one roster edit per window
+
+class RosterView:
+    """The roster message of a chat, rendered one block per team and edited at most once per ROSTER_DEBOUNCE."""
+    __slots__ = ("message_id", "markup", "blocks", "dirty", "joined", "header", "sent_text", "flush_job", "last_flush")
+
+    def __init__(self, message_id: int, markup: Optional[types.InlineKeyboardMarkup]):
+        self.message_id, self.markup = message_id, markup
+        self.blocks: Dict[str, str] = {}
+        self.dirty: Set[str] = set()
+        self.joined: List[Tuple[str, str]] = []  # (username, team) since the last edit
+        self.header = ""
+        self.sent_text: Optional[str] = None
+        self.flush_job: Optional[TimerJob] = None
+        self.last_flush = float("-inf")
+
+    def joined_team(self, username: str, team: str, old_team: Optional[str]):
+        self.joined.append((username, team))
+        self.dirty.add(team)
+        if old_team: self.dirty.add(old_team)
+
+    def render(self, session: GameSession) -> str:
+        stale = [team for team in session.teams_order if team in self.dirty or team not in self.blocks]
+        if stale:
+            names = users.names([uid for team in stale for uid in session.teams.get(team, [])])
+            for team in stale:
+                member_names = [f"@{names[uid]}" if names[uid] else f"User {uid}" for uid in session.teams.get(team, [])]
+                self.blocks[team] = f"\n*{_get_team_display_name(session, team)}:*\n" + ("\n".join(member_names) if member_names else "-\n")
+            self.dirty.clear()
+        if len(self.joined) == 1:
+            username, team = self.joined[0]
+            self.header = f"✅ @{username} приєднався до команди *{_get_team_display_name(session, team)}*!"
+        elif self.joined:
+            joined = list(dict.fromkeys(username for username, _ in self.joined))
+            more = f" та ще {len(joined) - 10}" if len(joined) > 10 else ""
+            self.header = "✅ До команд приєдналися: " + ", ".join(f"@{username}" for username in joined[:10]) + more + "!"
+        self.joined = []
+        return f"{self.header}\n\n*Склад команд:*" + "".join(self.blocks[team] for team in session.teams_order)
+
+def update_roster(session: GameSession, message: types.Message, username: str, team: str, old_team: Optional[str]):
+    """Records a join on the roster `message` and books its next debounced edit."""
+    roster = session.roster
+    if roster is None or roster.message_id != message.message_id:
+        if roster and roster.flush_job: roster.flush_job.cancel()
+        roster = session.roster = RosterView(message.message_id, message.reply_markup)
+    roster.joined_team(username, team, old_team)
+    if roster.flush_job is None:
+        roster.flush_job = timers.call_at(max(timers.clock(), roster.last_flush + ROSTER_DEBOUNCE), _flush_roster, session, roster)
+
+def _flush_roster(session: GameSession, roster: RosterView):
+    with session.lock:
+        roster.flush_job = None
+        if session.roster is not roster: return
+        roster.last_flush = timers.clock()
+        text = roster.render(session)
+        if text == roster.sent_text: return
+        roster.sent_text = text
+    outbox.send("edit_message_text", text, session.chat_id, roster.message_id, parse_mode="Markdown", reply_markup=roster.markup, coalesce=True)
+
+def _score_line(session: GameSession, team: str) -> str:
+    """'🚀 Team: *3* балів' for the scoreboards, re-rendered only when the team's score changed."""
+    score = session.teams_score.get(team, 0)
+    cached = session.score_lines.get(team)
+    if cached is None or cached[1] != score or cached[0] != session.team_emojis.get(team):
+        cached = session.score_lines[team] = (session.team_emojis.get(team), score, f"{_get_team_display_name(session, team)}: *{score}* балів\n")
+    return cached[2]
+@functools.lru_cache(maxsize=64)
+def _word_buttons(seq: int) -> str:
+    """Serialized keyboard for the seq-th word of a round; the number in its callback data marks stale taps."""
     markup = types.InlineKeyboardMarkup(row_width=3)
-    markup.add(types.InlineKeyboardButton("✅ Вгадано", callback_data="right"),
-               types.InlineKeyboardButton("❌ Ні", callback_data="wrong"),
-               types.InlineKeyboardButton("🔁 Пропустити", callback_data="skip"))
-    return markup
-def finish_game(chat_id: Optional[int] = None, silent: bool = False):
-    global game_active, round_in_progress, active_player_id, teams, user_teams, teams_score, teams_order, played_teams, used_words, available_words, player_states, current_turn_index, group_timer_message_id, team_emojis
-    target_chat_id = chat_id or current_chat_id
-    if active_player_id and active_player_id in player_states:
-        player_states[active_player_id]["timer_active"] = False
-    if not silent and target_chat_id != 0 and any(teams_score.values()):
-        summary = "🏁 *Гру завершено!*\n\n"
-        winner = max(teams_score, key=lambda k: teams_score[k])
-        for team, score in teams_score.items():
-            summary += f"{_get_team_display_name(team)}: *{score}* балів\n"
-        summary += f"\n🥇 Перемогла команда *{_get_team_display_name(winner)}*!\n🎁 Бонус +30 хв отримують:\n"
-        if teams.get(winner):
-            for uid in teams[winner]:
-                try:
-                    name = bot.get_chat(uid).username or bot.get_chat(uid).first_name
-                    summary += f"- @{name}\n"
-                except ApiTelegramException:
-                    summary += f"- User {uid}\n"
-        bot.send_message(target_chat_id, summary, parse_mode="Markdown")
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton("🎉 Розпочати нову гру", callback_data="setup_new_game"))
-        bot.send_message(target_chat_id, "Дякуємо за гру! Бажаєте зіграти ще раз?", reply_markup=markup)
-    teams, user_teams, teams_score, teams_order, team_emojis = {}, {}, {}, [], {}
-    played_teams, used_words, available_words, player_states = set(), [], [], {}
-    game_active, round_in_progress, active_player_id = False, False, None
-    current_turn_index = 0
-    group_timer_message_id = None
-def show_score():
-    summary = "📊 *Поточний рахунок:*\n"
-    for team_name in teams_order:
-        score = teams_score.get(team_name, 0)
-        summary += f"{_get_team_display_name(team_name)}: *{score}* балів\n"
-    if current_chat_id != 0: bot.send_message(current_chat_id, summary, parse_mode="Markdown")
-def update_timer_thread(user_id: int, start_time: float):
-    markup = _create_word_buttons()
-    while time.time() < start_time + ROUND_TIME:
-        state = player_states.get(user_id)
-        if not state or not state.get("timer_active"): break
-        remaining_time = int((start_time + ROUND_TIME) - time.time())
-        if remaining_time < 0: remaining_time = 0
-        new_text = f"🔤 Слово: *{state['current_word'].upper()}*\n⏱️ Залишилось: {remaining_time} сек"
-        group_timer_text = f"⏳ Залишилось часу: *{remaining_time}* сек"
-        try:
-            if state.get("player_message_id"):
-                if state.get("message_type") == "photo": bot.edit_message_caption(caption=new_text, chat_id=user_id, message_id=state["player_message_id"], parse_mode="Markdown", reply_markup=markup)
-                else: bot.edit_message_text(text=new_text, chat_id=user_id, message_id=state["player_message_id"], parse_mode="Markdown", reply_markup=markup)
-            if group_timer_message_id and current_chat_id: bot.edit_message_text(text=group_timer_text, chat_id=current_chat_id, message_id=group_timer_message_id, parse_mode="Markdown")
-        except ApiTelegramException as e:
-            if 'message is not modified' not in e.description: print(f"Timer update error: {e}")
-        time.sleep(1)
-    state = player_states.get(user_id)
-    if state and state.get("timer_active"): end_round(user_id, state["score"])
-def send_word_to_player(user_id: int, is_initial: bool = False):
-    state = player_states.get(user_id)
+    markup.add(types.InlineKeyboardButton("✅ Вгадано", callback_data=f"right:{seq}"),
+               types.InlineKeyboardButton("❌ Ні", callback_data=f"wrong:{seq}"),
+               types.InlineKeyboardButton("🔁 Пропустити", callback_data=f"skip:{seq}"))
+    return markup.to_json()
+def _seconds_left(state: PlayerState) -> int:
+    """Whole seconds left in the round, as both countdowns show them (rounded to the ms, so a tick on time shows its own second)."""
+    return max(0, math.ceil(round(state.deadline - timers.clock(), 3)))
+def _word_caption(state: PlayerState) -> str:
+    remaining = _seconds_left(state) if state.deadline else ROUND_TIME
+    return f"🔤 Слово: *{state.current_word.upper()}*\n⏱️ Залишилось: {remaining} сек"
+def finish_game(session: GameSession, silent: bool = False):
+    with session.lock:
+        if session.active_player_id: sessions.unbind_player(session.active_player_id, session.chat_id)
+        teams_score = session.teams_score
+        if not silent and any(teams_score.values()):
+            summary = "🏁 *Гру завершено!*\n\n"
+            winner = max(teams_score, key=lambda k: teams_score[k])
+            summary += "".join(_score_line(session, team) for team in teams_score)
+            summary += f"\n🥇 Перемогла команда *{_get_team_display_name(session, winner)}*!\n🎁 Бонус +30 хв отримують:\n"
+            if session.teams.get(winner):
+                names = users.names(session.teams[winner])
+                for uid in session.teams[winner]:
+                    summary += f"- @{names[uid]}\n" if names[uid] else f"- User {uid}\n"
+            outbox.send("send_message", session.chat_id, summary, parse_mode="Markdown", priority=PRIORITY_HIGH)
+            markup = types.InlineKeyboardMarkup()
+            markup.add(types.InlineKeyboardButton("🎉 Розпочати нову гру", callback_data="setup_new_game"))
+            outbox.send("send_message", session.chat_id, "Дякуємо за гру! Бажаєте зіграти ще раз?", reply_markup=markup)
+        session.reset()
+def show_score(session: GameSession):
+    summary = "📊 *Поточний рахунок:*\n" + "".join(_score_line(session, team) for team in session.teams_order)
+    outbox.send("send_message", session.chat_id, summary, parse_mode="Markdown")
+def _round_tick(session: GameSession, state: PlayerState, tick: int):
+    """Refreshes both countdowns, then books the next whole-second tick counted from the round start."""
+    with session.lock:  # only queues edits; the lock keeps the word and the re-arm in step with stop_timer()
+        if session.player is state and state.timer_active: _refresh_countdowns(session, state, tick)
+def _refresh_countdowns(session: GameSession, state: PlayerState, tick: int):
+    remaining_time = _seconds_left(state)  # not ROUND_TIME - tick: a late tick shows the time actually left
+    new_text = f"🔤 Слово: *{state.current_word.upper()}*\n⏱️ Залишилось: {remaining_time} сек"
+    group_timer_text = f"⏳ Залишилось часу: *{remaining_time}* сек"
+    markup = _word_buttons(state.word_count)
+    if state.player_message_id:
+        if state.message_type == "photo": outbox.send("edit_message_caption", caption=new_text, chat_id=state.user_id, message_id=state.player_message_id, parse_mode="Markdown", reply_markup=markup, priority=PRIORITY_LOW, coalesce=True)
+        else: outbox.send("edit_message_text", text=new_text, chat_id=state.user_id, message_id=state.player_message_id, parse_mode="Markdown", reply_markup=markup, priority=PRIORITY_LOW, coalesce=True)
+    if session.group_timer_message_id: outbox.send("edit_message_text", text=group_timer_text, chat_id=session.chat_id, message_id=session.group_timer_message_id, parse_mode="Markdown", priority=PRIORITY_LOW, coalesce=True)
+    # Ticks only queue edits, but skip any the executor was too busy to run on time.
+    start = state.deadline - ROUND_TIME
+    next_tick = max(tick + 1, math.floor(timers.clock() - start) + 1)
+    state.tick_job = timers.call_at(start + next_tick, _round_tick, session, state, next_tick) if next_tick < ROUND_TIME else None
+def _group_timer_sent(session: GameSession, state: PlayerState, future: Future):
+    # Runs on an outbox worker that still holds the chat, so the session lock is taken on the timer executor instead.
+    msg = None if future.exception() else future.result()
+    if isinstance(msg, types.Message): timers.call_at(timers.clock(), _attach_group_timer, session, state, msg.message_id)
+def _attach_group_timer(session: GameSession, state: PlayerState, message_id: int):
+    with session.lock:
+        if session.player is state and state.timer_active: session.set_group_timer_message(message_id)
+        else: outbox.send("edit_message_text", text="⌛️ Час вийшов!", chat_id=session.chat_id, message_id=message_id, coalesce=True)  # the round ended first
+def _round_timeout(session: GameSession, state: PlayerState):
+    with session.lock:
+        if session.player is state and state.timer_active: end_round(session, state.user_id, state.score)
+def _start_round_timer(session: GameSession, state: PlayerState):
+    now = timers.clock()
+    state.deadline = now + max(0.0, state.ends_at - time.time())
+    start = state.deadline - ROUND_TIME
+    first_tick = math.floor(now - start) + 1
+    state.timeout_job = timers.call_at(state.deadline, _round_timeout, session, state)
+    if first_tick < ROUND_TIME: state.tick_job = timers.call_at(start + first_tick, _round_tick, session, state, first_tick)
+def _send_photo(state: PlayerState, photo: Any, caption: str, markup: str) -> Any:
+    return outbox.call("send_photo", state.user_id, photo, caption=caption, parse_mode="Markdown", reply_markup=markup)
+def _send_word_photo(state: PlayerState, image_path: str, caption: str, markup: str) -> Any:
+    """Sends the word's picture by cached file_id, uploading the file only when there is none (or it was rejected)."""
+    word = state.current_word
+    file_id = media.file_id(word)
+    if file_id:
+        try: return _send_photo(state, file_id, caption, markup)
+        except ApiTelegramException: media.forget(word)
+    with open(image_path, "rb") as img:
+        msg = _send_photo(state, img, caption, markup)
+    media.store(word, msg)
+    return msg
+def send_word_to_player(session: GameSession, is_initial: bool = False):
+    state = session.player
     if not state: return
-    word = state["current_word"]
-    markup = _create_word_buttons()
-    caption = f"🔤 Слово: *{word.upper()}*\n⏱️ Залишилось: {ROUND_TIME} сек"
-    photo_path = f"images/{word.lower()}.png"
-    try:
-        with open(photo_path, "rb") as img:
-            if is_initial:
-                msg = bot.send_photo(user_id, img, caption=caption, parse_mode="Markdown", reply_markup=markup)
-                if msg: state["player_message_id"] = msg.message_id; state["message_type"] = "photo"
-            else:
-                img.seek(0)
-                media = types.InputMediaPhoto(img, caption=caption, parse_mode="Markdown") # type: ignore
-                if state.get("player_message_id"): bot.edit_message_media(media=media, chat_id=user_id, message_id=state["player_message_id"], reply_markup=markup); state["message_type"] = "photo"
-    except (FileNotFoundError, ApiTelegramException):
+    user_id = state.user_id
+    markup = _word_buttons(state.word_count)
+    caption = _word_caption(state)
+    image_path = media.image_path(state.current_word)
+    if is_initial:
+        if image_path:
+            try:
+                msg = _send_word_photo(state, image_path, caption, markup)
+                session.set_player_message(msg.message_id if msg else None, "photo")
+                return
+            except (OSError, ApiTelegramException):
+                pass
         try:
-            if is_initial:
-                msg = bot.send_message(user_id, caption, parse_mode="Markdown", reply_markup=markup)
-                if msg: state["player_message_id"] = msg.message_id; state["message_type"] = "text"
-            else:
-                if state.get("player_message_id"): bot.edit_message_text(text=caption, chat_id=user_id, message_id=state["player_message_id"], reply_markup=markup); state["message_type"] = "text"
+            msg = outbox.call("send_message", user_id, caption, parse_mode="Markdown", reply_markup=markup)
+            if msg: session.set_player_message(msg.message_id, "text")
         except ApiTelegramException as e:
-            bot.send_message(user_id, f"Помилка! {e}. Раунд завершено достроково.")
-            if user_id in player_states: end_round(user_id, player_states[user_id]['score'])
-def end_round(user_id: int, score: int):
-    global round_in_progress, active_player_id, current_turn_index, group_timer_message_id
-    if not round_in_progress: return
-    if user_id in player_states: player_states[user_id]["timer_active"] = False
-    round_in_progress, active_player_id = False, None
-    team = player_states.get(user_id, {}).get("team")
-    try: user_info = bot.get_chat(user_id); username = user_info.username or user_info.first_name
-    except ApiTelegramException: username = f"Гравець {user_id}"
+            _abort_round(session, state, e)
+        return
+    if not state.player_message_id: return
+    # Nothing below waits for Telegram: the click handler returns while the edit is in flight. Each edit
+    # shares the countdown's coalescing key, so a still-queued tick of the previous word is replaced.
+    if state.message_type == "photo":
+        outbox.discard("edit_message_caption", user_id, state.player_message_id)  # a queued countdown of the old word
+        if image_path and _edit_word_photo(session, state, image_path, caption, markup): return
+        # A photo message cannot become text, so a word without a picture only replaces the caption.
+        future = outbox.submit("edit_message_caption", caption=caption, chat_id=user_id, message_id=state.player_message_id, parse_mode="Markdown", reply_markup=markup, coalesce=True)
+    else:
+        future = outbox.submit("edit_message_text", text=caption, chat_id=user_id, message_id=state.player_message_id, parse_mode="Markdown", reply_markup=markup, coalesce=True)
+    future.add_done_callback(lambda f: _word_edit_done(session, state, f))
+def _edit_word_photo(session: GameSession, state: PlayerState, image_path: str, caption: str, markup: str) -> bool:
+    """Queues the swap to the current word's picture, by cached file_id or by upload; False if the file is unreadable."""
+    file_id = media.file_id(state.current_word)
+    if file_id: photo: Any = file_id
+    else:
+        try:
+            with open(image_path, "rb") as img: photo = img.read()
+        except OSError: return False
+    media_photo = types.InputMediaPhoto(photo, caption=caption, parse_mode="Markdown") # type: ignore
+    future = outbox.submit("edit_message_media", media=media_photo, chat_id=state.user_id, message_id=state.player_message_id, reply_markup=markup, coalesce=True)
+    future.add_done_callback(lambda f, seq=state.word_count: _word_photo_sent(session, state, seq, bool(file_id), f))
+    return True
+def _word_photo_sent(session: GameSession, state: PlayerState, seq: int, reused: bool, future: Future):
+    e = future.exception()
+    if (e is None and reused) or (isinstance(e, ApiTelegramException) and 'message is not modified' in e.description): return
+    timers.call_at(timers.clock(), _settle_word_photo, session, state, seq, reused, future)
+def _settle_word_photo(session: GameSession, state: PlayerState, seq: int, reused: bool, future: Future):
+    """Records the uploaded picture's file_id, or retries a rejected file_id by upload, or gives the round up."""
+    e = future.exception()
+    with session.lock:
+        if session.player is not state or state.word_count != seq: return  # a newer word's edit replaced this one
+        if e is None: media.store(state.current_word, future.result())
+        elif reused and isinstance(e, ApiTelegramException): media.forget(state.current_word); send_word_to_player(session)
+        else: _abort_round(session, state, e)
+def _abort_round(session: GameSession, state: PlayerState, error: Exception):
+    outbox.send("send_message", state.user_id, f"Помилка! {error}. Раунд завершено достроково.")
+    with session.lock:
+        if session.player is state: end_round(session, state.user_id, state.score)
+def _word_edit_done(session: GameSession, state: PlayerState, future: Future):
+    # Runs on an outbox worker that still holds the chat, so the session lock is taken on the timer executor instead.
+    e = future.exception()
+    if e is None or (isinstance(e, ApiTelegramException) and 'message is not modified' in e.description): return
+    timers.call_at(timers.clock(), _abort_round, session, state, e)
+@instrumented("end_round")
+def end_round(session: GameSession, user_id: int, score: int):
+    if not session.round_in_progress: return
+    group_timer_message_id = session.group_timer_message_id
+    state = session.close_round()
+    sessions.unbind_player(user_id, session.chat_id)
+    if state and history:
+        if len(state.answers) < state.word_count:  # the round ran out on a word nobody answered
+            state.answers.append((time.time(), state.current_word, RESULT_TIMEOUT, int((time.monotonic() - state.shown_at) * 1000)))
+        history.record_round(session.chat_id, state.team, user_id, state.answers)
+    team = state.team if state else None
+    username = users.name(user_id) or f"Гравець {user_id}"
     result_message = f"✅ Раунд завершено! @{username} набрав *{score}* балів"
     if team:
-        if team not in teams_score: teams_score[team] = 0
-        teams_score[team] += score
-        display_team_name = _get_team_display_name(team)
+        display_team_name = _get_team_display_name(session, team)
         result_message += f" для команди *{display_team_name}*"
-    if current_chat_id != 0:
-        if group_timer_message_id:
-            try: bot.edit_message_text(text="⌛️ Час вийшов!", chat_id=current_chat_id, message_id=group_timer_message_id); group_timer_message_id = None
-            except ApiTelegramException: pass
-        bot.send_message(current_chat_id, result_message, parse_mode="Markdown")
-        try: bot.send_message(user_id, result_message, parse_mode="Markdown")
-        except ApiTelegramException: pass
-        show_score()
-        is_circle_complete = (current_turn_index + 1) >= len(teams_order)
-        if is_circle_complete:
-            current_turn_index = 0
-            markup = types.InlineKeyboardMarkup()
-            markup.add(types.InlineKeyboardButton("🔄 Нове коло", callback_data="new_circle"), types.InlineKeyboardButton("🏁 Завершити гру", callback_data="finish_game"))
-            bot.send_message(current_chat_id, "Круг завершено! Що робимо далі?", reply_markup=markup)
-        else:
-            current_turn_index += 1
-            next_team = teams_order[current_turn_index]
-            display_next_team = _get_team_display_name(next_team)
-            markup = types.InlineKeyboardMarkup()
-            markup.add(types.InlineKeyboardButton("▶️ Почати раунд", callback_data="start_game"))
-            bot.send_message(current_chat_id, f"Хід переходить до команди *{display_next_team}*! Гравець з цієї команди має натиснути кнопку:", reply_markup=markup)
-def start_round_for_player(user_id: int):
-    team = user_teams.get(user_id, "Без команди")
-    if not available_words:
-        if current_chat_id != 0: bot.send_message(current_chat_id, "⚠️ Слова закінчились! Завершення гри.")
-        finish_game(); return
-    player_states[user_id] = {"score": 0, "team": team, "word_count": 1, "player_message_id": None, "current_word": available_words.pop(), "timer_active": True, "message_type": "text"}
-    if team != "Без команди": played_teams.add(team)
-    send_word_to_player(user_id, is_initial=True)
-    threading.Thread(target=update_timer_thread, args=(user_id, time.time())).start()
-
-# --- Helper to handle global commands during next_step_handler ---
-def handle_global_commands_in_step(message: types.Message) -> bool:
-    """Checks if a message received during a next_step_handler is a global command and processes it."""
-    if message.text and message.text.startswith('/'):
-        # Strip the bot username if it's present (e.g., /finish@your_bot)
-        command_text = message.text.split('@')[0]
-
-        if command_text == '/finish':
-            bot.send_message(message.chat.id, "🛑 Завершую гру за вашою командою!")
-            finish_game(message.chat.id)
-            return True # Indicates command was handled
-        elif command_text == '/start':
-            start(message)
-            return True
-        elif command_text == '/setup':
-            setup_command(message)
-            return True
-        # Add other global commands here if needed
-    return False # Indicates message was not a global command
+    chat_id = session.chat_id
+    if group_timer_message_id:
+        # Same coalescing key as the countdown ticks, so a still-queued tick is replaced rather than sent after this.
+        outbox.send("edit_message_text", text="⌛️ Час вийшов!", chat_id=chat_id, message_id=group_timer_message_id, coalesce=True)
+    outbox.send("send_message", chat_id, result_message, parse_mode="Markdown", priority=PRIORITY_HIGH)
+    outbox.send("send_message", user_id, result_message, parse_mode="Markdown", priority=PRIORITY_HIGH)
+    show_score(session)
+    if session.advance_turn():
+        markup = types.InlineKeyboardMarkup()
+        markup.add(types.InlineKeyboardButton("🔄 Нове коло", callback_data="new_circle"), types.InlineKeyboardButton("🏁 Завершити гру", callback_data="finish_game"))
+        outbox.send("send_message", chat_id, "Круг завершено! Що робимо далі?", reply_markup=markup)
+    else:
+        next_team = session.teams_order[session.current_turn_index]
+        display_next_team = _get_team_display_name(session, next_team)
+        markup = types.InlineKeyboardMarkup()
+        markup.add(types.InlineKeyboardButton("▶️ Почати раунд", callback_data="start_game"))
+        outbox.send("send_message", chat_id, f"Хід переходить до команди *{display_next_team}*! Гравець з цієї команди має натиснути кнопку:", reply_markup=markup)
+def start_round_for_player(session: GameSession, user_id: int, timer_message_id: Optional[int]):
+    if not session.has_words():
+        sessions.unbind_player(user_id, session.chat_id)
+        outbox.send("send_message", session.chat_id, "⚠️ Слова закінчились! Завершення гри.")
+        finish_game(session); return
+    state = session.begin_round(user_id, timer_message_id, time.time() + ROUND_TIME)
+    send_word_to_player(session, is_initial=True)
+    _start_round_timer(session, state)
+    session.prefetch_word()
+def _restore_session(session: GameSession):
+    """SessionRegistry hook: rebuilds a chat's game from the store and resumes its interrupted round."""
+    if cluster and not cluster.lease(session.chat_id, CLUSTER_LEASE_TIMEOUT):
+        raise RuntimeError(f"chat {session.chat_id} is still held by another worker")
+    if store is None: return
+    session.journal = store.record
+    saved = store.load(session.chat_id)
+    if saved is None: return
+    snapshot, events = saved
+    try:
+        if snapshot: session.restore(snapshot)
+        for kind, data in events: session.replay(kind, data)
+    except Exception as e:  # an event from a newer build or a damaged row: start the chat over rather than fail every update
+        print(f"Stored state of chat {session.chat_id} is unreadable, resetting it: {e!r}")
+        session.reset()
+        return
+    session.events_since_snapshot = len(events)
+    state = session.player
+    if session.round_in_progress and state:
+        sessions.bind_player(state.user_id, session.chat_id)
+        _start_round_timer(session, state)  # a deadline that passed while we were down fires at once and closes the round
+def restore_active_games():
+    """Loads the stored games with a round in progress, so rounds interrupted by a restart are resumed or closed."""
+    if store is None: return
+    if cluster: return cluster.ensure_started()  # each worker adopts its own share once membership settles
+    for chat_id in store.active_chat_ids(): sessions.get(chat_id)
+sessions.on_create = _restore_session
 
+@bot.middleware_handler(update_types=['message', 'callback_query'])
+def remember_sender(bot_instance: telebot.TeleBot, update: types.Message | types.CallbackQuery):
+    users.remember(update.from_user)
 
-# (All handlers are unchanged)
 @bot.message_handler(commands=['setup'])
 def setup_command(message: types.Message):
-    finish_game(message.chat.id, silent=True)
-    global current_chat_id; current_chat_id = message.chat.id
-    msg = bot.send_message(message.chat.id, "Скільки команд буде грати? (введіть число)")
-    bot.register_next_step_handler(msg, process_team_count)
+    """`/setup` opens the wizard; `/setup Назва 1, Назва 2` names the teams in one go."""
+    _, _, args = (message.text or "").partition(" ")
+    names = [name.strip() for name in args.split(",") if name.strip()] if args.strip() else None
+    if names is not None:
+        problem = _team_names_problem(names)
+        if problem: return outbox.send("send_message", message.chat.id, problem)
+    open_setup(sessions.get(message.chat.id), names=names)
 
 # --- NEW /finish command handler ---
 @bot.message_handler(commands=['finish'])
 def finish_command(message: types.Message):
     """Handles the /finish command to stop the current game."""
-    bot.send_message(message.chat.id, "🛑 Завершую гру за вашою командою!")
-    finish_game(message.chat.id)
-
-def process_team_count(message: types.Message):
-    if handle_global_commands_in_step(message):
-        # If a global command was handled, clear the current step handler
-        bot.clear_step_handler_by_chat_id(chat_id=message.chat.id)
-        return
-
-    try:
-        if not message.text: raise ValueError("Input is not text")
-        count = int(message.text)
-        if not 2 <= count <= 10: raise ValueError("Invalid number of teams")
-        msg = bot.send_message(message.chat.id, f"Введіть назву для Команди 1:")
-        bot.register_next_step_handler(msg, process_team_name, 1, count, [])
-    except (ValueError, TypeError):
-        msg = bot.send_message(message.chat.id, "Будь ласка, введіть число від 2 до 10.")
-        bot.register_next_step_handler(msg, process_team_count) # Re-register for valid input
-
-def process_team_name(message: types.Message, current_num: int, total_teams: int, collected_names: List[str]):
-    if handle_global_commands_in_step(message):
-        # If a global command was handled, clear the current step handler
-        bot.clear_step_handler_by_chat_id(chat_id=message.chat.id)
-        return
+    outbox.send("send_message", message.chat.id, "🛑 Завершую гру за вашою командою!")
+    finish_game(sessions.get(message.chat.id))
 
-    if not message.text:
-        msg = bot.send_message(message.chat.id, "Будь ласка, надішліть текстову назву для команди.")
-        bot.register_next_step_handler(msg, process_team_name, current_num, total_teams, collected_names); return
-    team_name = message.text.strip()
-    if not team_name:
-        msg = bot.send_message(message.chat.id, "Назва команди не може бути порожньою. Спробуйте ще раз:")
-        bot.register_next_step_handler(msg, process_team_name, current_num, total_teams, collected_names); return
-    collected_names.append(team_name)
-    if current_num < total_teams:
-        msg = bot.send_message(message.chat.id, f"Дякую! Тепер введіть назву для Команди {current_num + 1}:")
-        bot.register_next_step_handler(msg, process_team_name, current_num + 1, total_teams, collected_names)
-    else:
-        global teams, teams_score, teams_order, team_emojis
-        for i, name in enumerate(collected_names):
-            teams[name] = []; teams_score[name] = 0; teams_order.append(name)
-            team_emojis[name] = TEAM_EMOJIS[i % len(TEAM_EMOJIS)]
-        bot.send_message(message.chat.id, "Чудово! Команди налаштовано. Можна починати гру, надіславши команду /start.")
+# --- /setup wizard: one message, edited on every tap ---
+# Callback data is "su:n:<count>", "su:t:<slot>:<preset>", "su:a" (random names for the rest) or "su:b" (back);
+# the step reached lives in the session (draft_setup), so a tap is valid only against the latest wizard
+# message and, for names, only for the slot it was rendered for.
+SETUP_TITLE = "⚙️ *Налаштування гри*"
+def _team_names_problem(names: List[str]) -> Optional[str]:
+    if not 2 <= len(names) <= 10: return "Потрібно від 2 до 10 назв команд через кому."
+    if len(set(names)) != len(names): return "Назви команд мають бути різними."
+    if any(c in name for name in names for c in "*_`["): return "Назви команд не можуть містити символи * _ ` [."  # they are shown with Markdown
+    if any(len(f"team_{name}".encode("utf-8")) > 64 for name in names): return "Назва команди задовга, скоротіть її."  # callback_data limit
+    return None
+def _setup_view(session: GameSession) -> Tuple[str, types.InlineKeyboardMarkup]:
+    count, names = session.setup_count, session.setup_names
+    if not count:
+        markup = types.InlineKeyboardMarkup(row_width=5)
+        markup.add(*[types.InlineKeyboardButton(str(n), callback_data=f"su:n:{n}") for n in range(2, 11)])
+        return f"{SETUP_TITLE}\n\nСкільки команд буде грати?", markup
+    lines = "".join(f"{i + 1}. {names[i] if i < len(names) else '…'}\n" for i in range(count))
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    markup.add(*[types.InlineKeyboardButton(name, callback_data=f"su:t:{len(names)}:{i}") for i, name in enumerate(TEAM_NAME_PRESETS) if name not in names])
+    markup.row(types.InlineKeyboardButton("↩️ Назад", callback_data="su:b"), types.InlineKeyboardButton("🎲 Решта випадково", callback_data="su:a"))
+    return f"{SETUP_TITLE}\n\nКоманд: {count}\n{lines}\nОберіть назву для Команди {len(names) + 1}:", markup
+def _deck_step(session: GameSession) -> Tuple[str, Optional[types.InlineKeyboardMarkup]]:
+    """What the wizard shows once the teams are set: the deck picker, the difficulty picker or the final word."""
+    teams = ", ".join(_get_team_display_name(session, name) for name in session.teams_order)
+    if len(word_bank.categories) > 1: return f"{SETUP_TITLE}\n\nКоманди: {teams}\n\n📚 Оберіть набір слів:", _deck_buttons()
+    if word_bank.difficulties(None): return f"{SETUP_TITLE}\n\nКоманди: {teams}\n\n🎚️ Оберіть складність слів:", _difficulty_buttons(None)
+    return SETUP_DONE_TEXT, None
+def open_setup(session: GameSession, names: Optional[List[str]] = None, message_id: Optional[int] = None):
+    """Ends any game and shows the wizard, in a new message or by editing `message_id`."""
+    finish_game(session, silent=True)
+    with session.lock:
+        if names: session.configure_teams(names); text, markup = _deck_step(session)
+        else: text, markup = _setup_view(session); session.draft_setup(message_id)
+    # Sent without the session lock, so a group over its rate limit never stalls the chat's timers;
+    # the ingestor still holds back this chat's next update until the wizard is recorded below.
+    shown = message_id
+    if message_id:
+        try: outbox.call("edit_message_text", text, chat_id=session.chat_id, message_id=message_id, parse_mode="Markdown", reply_markup=markup)
+        except ApiTelegramException: shown = None
+    if not shown:
+        msg = outbox.call("send_message", session.chat_id, text, parse_mode="Markdown", reply_markup=markup)
+        shown = msg.message_id if msg else None
+    if not names and shown != message_id:
+        with session.lock:
+            if session.setup_message_id == message_id and not session.teams and not session.setup_count: session.draft_setup(shown)
+@bot.callback_query_handler(func=lambda call: call.data.startswith("su:"))
+def setup_step(call: types.CallbackQuery):
+    if not call.data or not call.message: return
+    session = sessions.get(call.message.chat.id)
+    step = call.data.split(":")[1:]
+    with session.lock:
+        if session.game_active or session.setup_message_id != call.message.message_id:
+            return outbox.send("answer_callback_query", call.id, "Це налаштування вже неактуальне. Почніть заново: /setup", show_alert=True, priority=PRIORITY_HIGH)
+        if session.teams: return outbox.send("answer_callback_query", call.id, priority=PRIORITY_HIGH)  # a late tap after the last name
+        count, names = session.setup_count, list(session.setup_names)
+        free = [name for name in TEAM_NAME_PRESETS if name not in names]
+        if step[0] == "n" and not count and step[1:] and step[1].isdigit() and 2 <= int(step[1]) <= 10: count = int(step[1])
+        elif (step[0] == "t" and count and len(step) == 3 and step[1] == str(len(names)) and step[2].isdigit()
+              and int(step[2]) < len(TEAM_NAME_PRESETS) and TEAM_NAME_PRESETS[int(step[2])] in free):
+            names.append(TEAM_NAME_PRESETS[int(step[2])])
+        elif step[0] == "a" and count: names += random.sample(free, count - len(names))
+        elif step[0] == "b" and count:
+            if names: names.pop()
+            else: count = 0
+        else: return outbox.send("answer_callback_query", call.id, priority=PRIORITY_HIGH)  # a double tap on a step already taken
+        if count and len(names) == count: session.configure_teams(names); text, markup = _deck_step(session)
+        else: session.draft_setup(session.setup_message_id, count, names); text, markup = _setup_view(session)
+    outbox.send("answer_callback_query", call.id, priority=PRIORITY_HIGH)
+    outbox.send("edit_message_text", text, chat_id=call.message.chat.id, message_id=call.message.message_id, parse_mode="Markdown", reply_markup=markup, coalesce=True)
+SETUP_DONE_TEXT = "Чудово! Команди налаштовано. Можна починати гру, надіславши команду /start."
+def _deck_buttons() -> types.InlineKeyboardMarkup:
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    markup.add(*[types.InlineKeyboardButton(f"📖 {name}", callback_data=f"deck_{i}") for i, name in enumerate(word_bank.categories)])
+    markup.add(types.InlineKeyboardButton("🎲 Усі слова", callback_data="deck_all"))
+    return markup
+def _difficulty_buttons(categories: Optional[List[str]]) -> types.InlineKeyboardMarkup:
+    markup = types.InlineKeyboardMarkup(row_width=3)
+    markup.add(*[types.InlineKeyboardButton(DIFFICULTY_NAMES.get(level, str(level)), callback_data=f"diff_{level}") for level in word_bank.difficulties(categories)])
+    markup.add(types.InlineKeyboardButton("🎲 Будь-які", callback_data="diff_0"))
+    return markup
+@bot.callback_query_handler(func=lambda call: call.data.startswith(("deck_", "diff_")))
+def choose_deck(call: types.CallbackQuery):
+    if not call.data or not call.message: return
+    session = sessions.get(call.message.chat.id)
+    with session.lock:
+        if session.game_active or not session.teams:
+            return outbox.send("answer_callback_query", call.id, "Набір слів можна змінити лише під час налаштування гри.", show_alert=True, priority=PRIORITY_HIGH)
+        kind, _, value = call.data.partition("_")
+        if kind == "deck":
+            if value != "all" and not (value.isdigit() and int(value) < len(word_bank.categories)): return
+            categories = None if value == "all" else [word_bank.categories[int(value)]]
+            session.choose_deck(categories)
+            if word_bank.difficulties(categories): text, markup = "🎚️ Оберіть складність слів:", _difficulty_buttons(categories)
+            else: text, markup = SETUP_DONE_TEXT, None
+        else:
+            if not value.isdigit(): return
+            session.choose_deck(session.deck_categories, int(value))
+            text, markup = SETUP_DONE_TEXT, None
+    outbox.send("answer_callback_query", call.id, priority=PRIORITY_HIGH)
+    outbox.send("edit_message_text", text, chat_id=call.message.chat.id, message_id=call.message.message_id, reply_markup=markup)
+@bot.message_handler(commands=["leaderboard"])
+def leaderboard_command(message: types.Message):
+    if history is None: return outbox.send("send_message", message.chat.id, "Статистика вимкнена.")
+    players, teams = history.leaderboard(message.chat.id)
+    if not players: return outbox.send("send_message", message.chat.id, "Ще немає зіграних раундів. Почніть гру через /start!")
+    session = sessions.get(message.chat.id)
+    names = users.names([uid for uid, _ in players])
+    text = "🏆 *Таблиця лідерів чату*\n\n*Гравці:*\n"
+    for place, (uid, (points, words, rounds)) in enumerate(players, 1):
+        text += f"{place}. {'@' + names[uid] if names[uid] else f'User {uid}'} — *{points}* балів ({words} слів, {rounds} раундів)\n"
+    text += "\n*Команди:*\n" + "".join(f"{_get_team_display_name(session, team)} — *{points}* балів\n" for team, (points, _) in teams)
+    outbox.send("send_message", message.chat.id, text, parse_mode="Markdown")
+@bot.message_handler(commands=["stats"])
+def stats_command(message: types.Message):
+    if history is None: return outbox.send("send_message", message.chat.id, "Статистика вимкнена.")
+    rounds, words, guessed, guess_ms = history.chat_stats(message.chat.id)
+    hardest, easiest = history.word_extremes()
+    text = (f"📈 *Статистика чату*\nРаундів: *{rounds}*\nСлів показано: *{words}*\n"
+            f"Вгадано: *{guessed}* ({guessed * 100 // words if words else 0}%)\n")
+    if guessed: text += f"Середній час відгадування: *{guess_ms / guessed / 1000:.1f}* с\n"
+    line = lambda word, totals: f"• {word} — {totals[1] * 100 // totals[0]}% ({totals[1]}/{totals[0]})\n"
+    if hardest: text += "\n*Найскладніші слова:*\n" + "".join(line(w, t) for w, t in hardest)
+    if easiest: text += "\n*Найлегші слова:*\n" + "".join(line(w, t) for w, t in easiest)
+    outbox.send("send_message", message.chat.id, text, parse_mode="Markdown")
 @bot.message_handler(commands=["start"])
 def start(message: types.Message):
-    global current_chat_id; current_chat_id = message.chat.id
-    if not teams:
-        bot.send_message(message.chat.id, "Доброго дня! 👋\n\nЩоб почати грати, адміністратор чату має спершу налаштувати команди за допомогою команди /setup"); return
+    session = sessions.get(message.chat.id)
+    if not session.teams:
+        outbox.send("send_message", message.chat.id, "Доброго дня! 👋\n\nЩоб почати грати, адміністратор чату має спершу налаштувати команди за допомогою команди /setup"); return
     rules = ("👋 *Вітаємо в Alias! Гра налаштована, можна починати.*\n\n" "📌 *Правила гри:*\n" "1. Усі гравці мають приєднатись до своїх команд, натиснувши на кнопку нижче.\n" "2. Бот автоматично визначить, яка команда ходить першою.\n" "3. Коли настане черга вашої команди, один гравець має натиснути 'Почати гру' або 'Почати раунд'.\n" "4. **Тільки гравець з команди, чия черга, може почати раунд.**\n" f"5. У вас є {ROUND_TIME} секунд або {ROUND_LIMIT} слів, щоб пояснити якомога більше.\n" "6. Вгадане слово — це +1 бал для вашої команди.\n\n" "🏆 *Приз для переможців: кожен гравець команди-переможця отримує +30 хв до перерви!*")
-    bot.send_message(current_chat_id, rules, parse_mode="Markdown")
+    outbox.send("send_message", session.chat_id, rules, parse_mode="Markdown")
     markup = types.InlineKeyboardMarkup()
-    for name in teams_order:
-        display_name = _get_team_display_name(name)
+    for name in session.teams_order:
+        display_name = _get_team_display_name(session, name)
         markup.add(types.InlineKeyboardButton(display_name, callback_data=f"team_{name}"))
-    bot.send_message(current_chat_id, "✏️ **Оберіть свою команду:**", reply_markup=markup)
+    outbox.send("send_message", session.chat_id, "✏️ **Оберіть свою команду:**", reply_markup=markup)
 @bot.callback_query_handler(func=lambda call: call.data.startswith("team_"))
+@instrumented("join_team")
 def join_team(call: types.CallbackQuery):
     if not call.data or not call.message: return
     team_name = call.data.replace("team_", "")
     user = call.from_user; uid = user.id; username = user.username or user.first_name
-    for t_name, members in teams.items():
-        if uid in members: members.remove(uid)
-    teams[team_name].append(uid)
-    user_teams[uid] = team_name
-    full_team_list = ""
-    for name in teams_order:
-        members = teams.get(name, [])
-        member_names = [f"@{bot.get_chat(m_id).username or bot.get_chat(m_id).first_name}" for m_id in members]
-        display_name = _get_team_display_name(name)
-        full_team_list += f"\n*{display_name}:*\n"
-        full_team_list += "\n".join(member_names) if member_names else "-\n"
-    try:
-        display_team_name = _get_team_display_name(team_name)
-        bot.edit_message_text(f"✅ @{username} приєднався до команди *{display_team_name}*!\n\n*Склад команд:*{full_team_list}", call.message.chat.id, call.message.message_id, parse_mode="Markdown", reply_markup=call.message.reply_markup)
-    except ApiTelegramException: pass
-    if not game_active:
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton("▶️ Почати гру", callback_data="start_game"))
-        bot.send_message(call.message.chat.id, "Коли всі приєднаються, перший гравець може починати гру!", reply_markup=markup)
+    session = sessions.get(call.message.chat.id)
+    with session.lock:
+        if team_name not in session.teams: return
+        old_team = session.user_teams.get(uid)
+        session.join(uid, team_name)
+        update_roster(session, call.message, username, team_name, old_team)
+        if not session.game_active and not session.start_prompt_sent:
+            session.start_prompt_sent = True
+            markup = types.InlineKeyboardMarkup()
+            markup.add(types.InlineKeyboardButton("▶️ Почати гру", callback_data="start_game"))
+            outbox.send("send_message", call.message.chat.id, "Коли всі приєднаються, перший гравець може починати гру!", reply_markup=markup)
+@instrumented("start_round_handler")
 def start_round_handler(message_or_call: types.Message | types.CallbackQuery):
-    global game_active, round_in_progress, active_player_id, available_words, current_turn_index, group_timer_message_id
     user = message_or_call.from_user
     if not user: return
     chat_id = message_or_call.message.chat.id if isinstance(message_or_call, types.CallbackQuery) else message_or_call.chat.id
     if not chat_id: return
-    if isinstance(message_or_call, types.CallbackQuery): bot.answer_callback_query(message_or_call.id)
-    if round_in_progress:
-        if isinstance(message_or_call, types.CallbackQuery): bot.answer_callback_query(message_or_call.id, "⏳ Зачекайте, раунд ще не завершено.", show_alert=True)
-        return
-    if not teams: return bot.send_message(chat_id, "Спочатку налаштуйте команди за допомогою /setup")
-    expected_team = teams_order[current_turn_index]
-    player_team = user_teams.get(user.id)
-    if not player_team:
-        if isinstance(message_or_call, types.CallbackQuery): bot.answer_callback_query(message_or_call.id, "Будь ласка, спершу приєднайтесь до команди.", show_alert=True)
-        return
-    if player_team != expected_team and game_active:
-        if isinstance(message_or_call, types.CallbackQuery):
-            display_expected_team = _get_team_display_name(expected_team)
-            bot.answer_callback_query(message_or_call.id, f"Зараз черга команди '{display_expected_team}', а не вашої.", show_alert=True)
-        return
-    if not game_active:
-        available_words = all_words.copy(); random.shuffle(available_words)
-        random.shuffle(teams_order)
-        current_turn_index = 0
-        expected_team = teams_order[current_turn_index]
-        game_active = True
-        bot.send_message(current_chat_id, f"🚀 Гра почалась! Першою ходить команда *{_get_team_display_name(expected_team)}*.")
-    timer_msg = bot.send_message(current_chat_id, f"⏳ Залишилось часу: *{ROUND_TIME}* сек", parse_mode="Markdown")
-    if timer_msg: group_timer_message_id = timer_msg.message_id
-    active_player_id = user.id
-    try:
-        username = user.username or user.first_name
-        if player_team:
-            display_player_team = _get_team_display_name(player_team)
-            bot.send_message(current_chat_id, f"Хід гравця @{username} з команди *{display_player_team}*! Повідомлення зі словом відправлено в особисті.", parse_mode="Markdown")
-        else: bot.send_message(current_chat_id, f"Хід гравця @{username}! Повідомлення зі словом відправлено в особисті.", parse_mode="Markdown")
-    except Exception: pass
-    round_in_progress = True
-    start_round_for_player(active_player_id)
+    session = sessions.get(chat_id)
+    with session.lock:
+        if session.round_in_progress:
+            if isinstance(message_or_call, types.CallbackQuery): outbox.send("answer_callback_query", message_or_call.id, "⏳ Зачекайте, раунд ще не завершено.", show_alert=True, priority=PRIORITY_HIGH)
+            return
+        if not session.teams: return outbox.send("send_message", chat_id, "Спочатку налаштуйте команди за допомогою /setup")
+        expected_team = session.teams_order[session.current_turn_index]
+        player_team = session.user_teams.get(user.id)
+        if not player_team:
+            if isinstance(message_or_call, types.CallbackQuery): outbox.send("answer_callback_query", message_or_call.id, "Будь ласка, спершу приєднайтесь до команди.", show_alert=True, priority=PRIORITY_HIGH)
+            return
+        if player_team != expected_team and session.game_active:
+            if isinstance(message_or_call, types.CallbackQuery):
+                display_expected_team = _get_team_display_name(session, expected_team)
+                outbox.send("answer_callback_query", message_or_call.id, f"Зараз черга команди '{display_expected_team}', а не вашої.", show_alert=True, priority=PRIORITY_HIGH)
+            return
+        if not sessions.bind_player(user.id, chat_id):
+            if isinstance(message_or_call, types.CallbackQuery): outbox.send("answer_callback_query", message_or_call.id, "Ви вже пояснюєте слова в іншому чаті.", show_alert=True, priority=PRIORITY_HIGH)
+            return
+        # Answered only once every check has passed: a second answer to the same query is rejected by Telegram.
+        if isinstance(message_or_call, types.CallbackQuery): outbox.send("answer_callback_query", message_or_call.id, priority=PRIORITY_HIGH)
+        if not session.game_active:
+            session.start_game(random.randrange(1 << 31))
+            expected_team = session.teams_order[session.current_turn_index]
+            outbox.send("send_message", chat_id, f"🚀 Гра почалась! Першою ходить команда *{_get_team_display_name(session, expected_team)}*.")
+        timer_msg = outbox.submit("send_message", chat_id, f"⏳ Залишилось часу: *{ROUND_TIME}* сек", parse_mode="Markdown")
+        try:
+            username = user.username or user.first_name
+            if player_team:
+                display_player_team = _get_team_display_name(session, player_team)
+                outbox.send("send_message", chat_id, f"Хід гравця @{username} з команди *{display_player_team}*! Повідомлення зі словом відправлено в особисті.", parse_mode="Markdown")
+            else: outbox.send("send_message", chat_id, f"Хід гравця @{username}! Повідомлення зі словом відправлено в особисті.", parse_mode="Markdown")
+        except Exception: pass
+        start_round_for_player(session, user.id, None)
+        state = session.player
+        if state: timer_msg.add_done_callback(lambda f: _group_timer_sent(session, state, f))
 @bot.callback_query_handler(func=lambda call: call.data == "start_game")
 def handle_start_round_callback(call: types.CallbackQuery): start_round_handler(call)
-@bot.callback_query_handler(func=lambda call: call.data in ["right", "wrong", "skip"])
+@bot.callback_query_handler(func=lambda call: call.data.split(":")[0] in ["right", "wrong", "skip"])
+@instrumented("handle_response")
 def handle_response(call: types.CallbackQuery):
     uid = call.from_user.id
-    if not round_in_progress or uid != active_player_id: return bot.answer_callback_query(call.id, "⏳ Зачекай свою чергу")
-    state = player_states.get(uid)
-    if not state: return bot.answer_callback_query(call.id, "Помилка: не знайдено стан гри.")
-    if call.data == "right": state["score"] += 1; bot.answer_callback_query(call.id, "✅ +1 бал")
-    else: bot.answer_callback_query(call.id, "⏭️ Наступне слово")
-    if state["word_count"] >= ROUND_LIMIT or not available_words: end_round(uid, state["score"]); return
-    state["current_word"] = available_words.pop()
-    state["word_count"] += 1
-    send_word_to_player(uid)
+    action, _, seq = call.data.partition(":")
+    session = sessions.for_player(uid)
+    if not session: return outbox.send("answer_callback_query", call.id, "⏳ Зачекай свою чергу", priority=PRIORITY_HIGH)
+    with session.lock:
+        if not session.round_in_progress or uid != session.active_player_id: return outbox.send("answer_callback_query", call.id, "⏳ Зачекай свою чергу", priority=PRIORITY_HIGH)
+        state = session.player
+        if not state: return outbox.send("answer_callback_query", call.id, "Помилка: не знайдено стан гри.", priority=PRIORITY_HIGH)
+        # A second tap on a word already answered, or a tap on an older message, must not score or skip again.
+        if (seq and seq != str(state.word_count)) or (call.message and state.player_message_id and call.message.message_id != state.player_message_id):
+            return outbox.send("answer_callback_query", call.id, priority=PRIORITY_HIGH)
+        state.answers.append((time.time(), state.current_word, RESULT_CODES[action], int((time.monotonic() - state.shown_at) * 1000)))
+        session.score_answer(action == "right")
+        if action == "right": outbox.send("answer_callback_query", call.id, "✅ +1 бал", priority=PRIORITY_HIGH)
+        else: outbox.send("answer_callback_query", call.id, "⏭️ Наступне слово", priority=PRIORITY_HIGH)
+        if state.word_count >= ROUND_LIMIT or not session.has_words(): end_round(session, uid, state.score); return
+        session.next_word()
+        send_word_to_player(session)
+        session.prefetch_word()
 @bot.callback_query_handler(func=lambda call: call.data == "new_circle")
 def handle_new_circle(call: types.CallbackQuery):
-    global current_turn_index
     if not call.message: return
-    bot.answer_callback_query(call.id)
-    current_turn_index = 0
-    if not teams_order: bot.send_message(call.message.chat.id, "Помилка: не знайдено команд. Почніть з /setup."); return
-    next_team = teams_order[current_turn_index]
-    display_next_team = _get_team_display_name(next_team)
+    outbox.send("answer_callback_query", call.id, priority=PRIORITY_HIGH)
+    session = sessions.get(call.message.chat.id)
+    with session.lock:
+        session.new_circle()
+        if not session.teams_order: outbox.send("send_message", call.message.chat.id, "Помилка: не знайдено команд. Почніть з /setup."); return
+        next_team = session.teams_order[session.current_turn_index]
+        display_next_team = _get_team_display_name(session, next_team)
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton("▶️ Почати раунд", callback_data="start_game"))
-    try: bot.edit_message_text(f"🔄 *Починаємо нове коло!*", chat_id=call.message.chat.id, message_id=call.message.message_id, parse_mode="Markdown", reply_markup=None)
+    try: outbox.call("edit_message_text", f"🔄 *Починаємо нове коло!*", chat_id=call.message.chat.id, message_id=call.message.message_id, parse_mode="Markdown", reply_markup=None)
     except ApiTelegramException as e: print(f"Could not edit 'new_circle' message: {e}")
-    bot.send_message(call.message.chat.id, f"Хід знову переходить до команди *{display_next_team}*! Гравець з цієї команди має натиснути кнопку:", reply_markup=markup)
+    outbox.send("send_message", call.message.chat.id, f"Хід знову переходить до команди *{display_next_team}*! Гравець з цієї команди має натиснути кнопку:", reply_markup=markup)
 @bot.callback_query_handler(func=lambda call: call.data == "finish_game")
 def callback_finish_game(call: types.CallbackQuery):
-    if call.message: finish_game(call.message.chat.id)
-    bot.answer_callback_query(call.id)
+    if call.message: finish_game(sessions.get(call.message.chat.id))
+    outbox.send("answer_callback_query", call.id, priority=PRIORITY_HIGH)
 @bot.callback_query_handler(func=lambda call: call.data == "setup_new_game")
 def handle_setup_new_game(call: types.CallbackQuery):
-    bot.answer_callback_query(call.id)
-    if isinstance(call.message, types.Message):
-        try: bot.edit_message_text("Починаємо налаштування нової гри...", chat_id=call.message.chat.id, message_id=call.message.message_id)
-        except ApiTelegramException: pass
-        setup_command(call.message)
-    else: bot.send_message(call.from_user.id, "Помилка: не вдалося запустити налаштування з цього повідомлення. Будь ласка, використайте команду /setup.")
+    outbox.send("answer_callback_query", call.id, priority=PRIORITY_HIGH)
+    if isinstance(call.message, types.Message): open_setup(sessions.get(call.message.chat.id), message_id=call.message.message_id)
+    else: outbox.send("send_message", call.from_user.id, "Помилка: не вдалося запустити налаштування з цього повідомлення. Будь ласка, використайте команду /setup.")
 
 # ===================================================================
 # === 3. Webhook Server & Startup Logic ===
 # ===================================================================
 
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", 16))
+INGEST_QUEUE_SIZE = int(os.environ.get("INGEST_QUEUE_SIZE", 256))  # per worker
+INGEST_PUT_TIMEOUT = 2.0
+INGEST_DEDUP_SIZE = 20000
+
+class UpdateIngestor:
+    """Processes updates from Telegram on a fixed pool of workers, each chat's strictly in order."""
+    def __init__(self, bot: telebot.TeleBot, workers: int = INGEST_WORKERS, queue_size: int = INGEST_QUEUE_SIZE):
+        self.bot = bot
+        self.workers = workers
+        self.queue_size = queue_size
+        self._queues: List[queue.Queue] = []
+        self._pid: Optional[int] = None
+        self._seen: "OrderedDict[int, None]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Called on the worker right before an update is handled, with the raw body it arrived with (if any);
+        # returning False means the update was passed on instead. Cluster uses it to follow ownership changes.
+        self.route: Optional[Callable[[types.Update, Optional[bytes]], bool]] = None
+        self.accepted = self.duplicates = self.rejected = self.processed = self.errors = 0
+
+    def _ensure_workers(self):
+        # Started lazily and per process: threads do not survive gunicorn's fork.
+        if self._pid == os.getpid(): return
+        with self._lock:
+            if self._pid == os.getpid(): return
+            self._queues = [queue.Queue(self.queue_size) for _ in range(self.workers)]
+            for i, q in enumerate(self._queues):
+                threading.Thread(target=self._work, args=(q,), name=f"ingest-{i}", daemon=True).start()
+            self._pid = os.getpid()
+
+    @staticmethod
+    def chat_key(update: types.Update) -> int:
+        """The chat whose order this update must respect; a player's private callbacks belong to their group."""
+        query = update.callback_query
+        if query:
+            if query.message and query.message.chat.id < 0: return query.message.chat.id  # a group button stays in its group
+            chat_id = sessions.chat_of_player(query.from_user.id)
+            if chat_id is not None: return chat_id
+            return query.message.chat.id if query.message else query.from_user.id
+        message = update.message or update.edited_message
+        return message.chat.id if message else update.update_id
+
+    def submit(self, update: types.Update, raw: Optional[bytes] = None) -> bool:
+        self._ensure_workers()
+        with self._lock:
+            if update.update_id in self._seen:
+                self.duplicates += 1; return True
+            self._seen[update.update_id] = None
+            if len(self._seen) > INGEST_DEDUP_SIZE: self._seen.popitem(last=False)
+        try:
+            self._queues[hash(self.chat_key(update)) % self.workers].put((update, raw), timeout=INGEST_PUT_TIMEOUT)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+                self._seen.pop(update.update_id, None)  # not taken, so Telegram's redelivery must get through
+            return False
+        with self._lock: self.accepted += 1
+        return True
+
+    def _work(self, q: queue.Queue):
+        while True:
+            update, raw = q.get()
+            try:
+                if self.route and not self.route(update, raw): continue
+                self.bot.process_new_updates([update])
+                self.processed += 1
+            except Exception as e:
+                self.errors += 1
+                print(f"Update {update.update_id} failed: {e!r}")
+
+    def stats(self) -> Dict[str, int]:
+        return {"queue_depth": sum(q.qsize() for q in self._queues), "accepted": self.accepted, "duplicates": self.duplicates,
+                "rejected": self.rejected, "processed": self.processed, "errors": self.errors}
+
+ingestor = UpdateIngestor(bot)
+
+# --- Sharding chats across worker processes ---
+CLUSTER_DIR = os.environ.get("CLUSTER_DIR", "")  # shared by all workers on the host; empty keeps everything in one process
+CLUSTER_REFRESH = 0.25      # seconds a membership view is trusted before the directory is scanned again
+CLUSTER_JOIN_GRACE = 1.0    # a new worker takes chats over only once every peer has had time to notice it
+CLUSTER_FORWARD_TIMEOUT = INGEST_PUT_TIMEOUT + 1
+CLUSTER_LEASE_TIMEOUT = 5.0  # how long an update waits for the previous owner to hand its chat over
+
+def _recv_exact(conn: socket.socket, size: int) -> Optional[bytes]:
+    data = b""
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk: return None
+        data += chunk
+    return data
+
+class Cluster:
+    """Shards chats across the worker processes sharing `directory`, forwarding each update to its chat's owner."""
+    def __init__(self, directory: str, ingestor: UpdateIngestor, refresh: float = CLUSTER_REFRESH):
+        self.directory = directory
+        self.ingestor = ingestor
+        self.refresh = refresh
+        self.name = ""
+        self._pid: Optional[int] = None
+        self._members: List[str] = []
+        self._members_at = 0.0
+        self._balanced: List[str] = []
+        self._peers: Dict[str, socket.socket] = {}
+        self._peer_locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self._lock_file: Any = None
+        self._lease_file: Any = None
+        self._leases: Set[int] = set()
+        self._unadopted: Set[int] = set()  # stored chats that are ours but whose lease the old owner still held
+        self.forwarded = self.received = self.forward_errors = self.lease_timeouts = 0
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def ensure_started(self):
+        # Per process, like the ingestor: the flock and the listener belong to this pid.
+        if self._pid == os.getpid(): return
+        with self._lock:
+            if self._pid == os.getpid(): return
+            os.makedirs(self._path("players"), exist_ok=True)
+            self.name = f"w-{os.getpid()}"
+            self._lock_file = open(self._path(self.name + ".lock"), "a")
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)  # held until this process exits, however it exits
+            # Record locks belong to the process and go when it closes any descriptor of the file, so this one stays open.
+            self._lease_file = open(self._path("chats.lock"), "a")
+            self._leases, self._unadopted = set(), set()
+            sock_path = self._path(self.name + ".sock")
+            if os.path.exists(sock_path): os.unlink(sock_path)  # left behind by a dead process with our pid
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server.bind(sock_path); server.listen(64)
+            self._peers, self._peer_locks, self._balanced = {}, {}, []
+            threading.Thread(target=self._serve, args=(server,), name="cluster-listener", daemon=True).start()
+            threading.Thread(target=self._maintain, name="cluster-maintain", daemon=True).start()
+            self._pid = os.getpid()
+
+    # --- Membership and ownership ---
+    def _alive(self, name: str) -> bool:
+        try:
+            with open(self._path(name + ".lock"), "a") as f:
+                try: fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError: return True
+                for suffix in (".sock", ".lock"):  # still under its lock, so no new worker with this pid can be mid-start
+                    try: os.unlink(self._path(name + suffix))
+                    except FileNotFoundError: pass
+                return False
+        except OSError:
+            return False
+
+    def _scan(self, prune: bool = False) -> List[str]:
+        live: List[Tuple[str, float]] = []
+        for path in glob.glob(self._path("w-*.sock")):
+            name = os.path.basename(path)[:-len(".sock")]
+            try: joined = os.stat(path).st_mtime
+            except FileNotFoundError: continue
+            if prune and name != self.name and not self._alive(name): continue
+            live.append((name, joined))
+        settled = [name for name, joined in live if joined <= time.time() - CLUSTER_JOIN_GRACE]
+        return sorted(settled or [name for name, _ in live])  # on a cold start everyone is new
+
+    def members(self) -> List[str]:
+        now = time.monotonic()
+        if now - self._members_at > self.refresh:
+            self._members, self._members_at = self._scan(), now
+        return self._members
+
+    @staticmethod
+    def _weight(member: str, key: int) -> int:
+        return int.from_bytes(hashlib.blake2b(f"{member}|{key}".encode(), digest_size=8).digest(), "big")
+
+    def owner(self, key: int) -> str:
+        members = self.members()
+        return max(members, key=lambda member: self._weight(member, key)) if members else self.name
+
+    def owns(self, chat_id: int) -> bool:
+        self.ensure_started()
+        return self.owner(chat_id) == self.name
+
+    # --- Leases ---
+    def lease(self, chat_id: int, timeout: float = 0.0) -> bool:
+        """Takes the chat's lease, waiting up to `timeout` for its previous owner to release it."""
+        self.ensure_started()
+        if chat_id in self._leases: return True
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.lockf(self._lease_file, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, chat_id % (1 << 62))
+            except OSError:
+                if time.monotonic() >= deadline: return False
+                time.sleep(0.05); continue
+            with self._lock: self._leases.add(chat_id)
+            return True
+
+    def _release(self, chat_id: int):
+        with self._lock: self._leases.discard(chat_id)
+        fcntl.lockf(self._lease_file, fcntl.LOCK_UN, 1, chat_id % (1 << 62))
+
+    # --- Player routing ---
+    def player_chat(self, user_id: int) -> Optional[int]:
+        try:
+            with open(self._path(f"players/{user_id}")) as f: return int(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def set_player(self, user_id: int, chat_id: Optional[int]):
+        """SessionRegistry hook: publishes which chat a player's private callbacks belong to."""
+        path = self._path(f"players/{user_id}")
+        try:
+            if chat_id is None: os.unlink(path); return
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f: f.write(str(chat_id))
+            os.replace(tmp, path)
+        except FileNotFoundError: pass
+        except OSError as e: print(f"Could not publish player {user_id}: {e}")
+
+    def chat_key(self, update: types.Update) -> int:
+        query = update.callback_query
+        if query and (query.message is None or query.message.chat.id > 0):
+            chat_id = sessions.chat_of_player(query.from_user.id)
+            if chat_id is None: chat_id = self.player_chat(query.from_user.id)
+            if chat_id is not None: return chat_id
+        return self.ingestor.chat_key(update)
+
+    # --- Forwarding ---
+    def submit(self, update: types.Update, raw: bytes) -> bool:
+        """Queues the update here if this worker owns its chat, otherwise hands it to the owner."""
+        self.ensure_started()
+        key = self.chat_key(update)
+        for _ in range(2):
+            owner = self.owner(key)
+            if owner == self.name: return self.ingestor.submit(update, raw)
+            try:
+                return self._forward(owner, raw)
+            except OSError as e:
+                self.forward_errors += 1
+                print(f"Forwarding to {owner} failed: {e!r}")
+                self._members, self._members_at = self._scan(prune=True), time.monotonic()
+        return False
+
+    def _forward(self, owner: str, raw: bytes) -> bool:
+        with self._lock: peer_lock = self._peer_locks.setdefault(owner, threading.Lock())
+        with peer_lock:
+            conn = self._peers.get(owner)
+            try:
+                if conn is None:
+                    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    conn.settimeout(CLUSTER_FORWARD_TIMEOUT)
+                    conn.connect(self._path(owner + ".sock"))
+                    self._peers[owner] = conn
+                conn.sendall(struct.pack(">I", len(raw)) + raw)
+                ack = conn.recv(1)
+                if not ack: raise ConnectionResetError("owner closed the connection")
+            except OSError:
+                self._peers.pop(owner, None)
+                if conn is not None: conn.close()
+                raise
+        self.forwarded += 1
+        return ack == b"\x01"
+
+    def route(self, update: types.Update, raw: Optional[bytes]) -> bool:
+        """Ingest hook: hands an update whose chat moved while it was queued to the new owner, else takes the lease."""
+        key = self.chat_key(update)
+        owner = self.owner(key)
+        if owner != self.name and raw is not None:  # forwarded updates (no raw) are not passed on again, so views that disagree cannot loop
+            try:
+                if not self._forward(owner, raw): print(f"Update {update.update_id} was refused by {owner}")
+                return False
+            except OSError as e:
+                self.forward_errors += 1
+                print(f"Forwarding to {owner} failed, handling here: {e!r}")
+        if self.lease(key, CLUSTER_LEASE_TIMEOUT): return True
+        self.lease_timeouts += 1
+        print(f"Dropping update {update.update_id}: chat {key} was not handed over in time")
+        return False
+
+    def _serve(self, server: socket.socket):
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=self._receive, args=(conn,), name="cluster-peer", daemon=True).start()
+
+    def _receive(self, conn: socket.socket):
+        with conn:
+            while True:
+                header = _recv_exact(conn, 4)
+                raw = _recv_exact(conn, struct.unpack(">I", header)[0]) if header else None
+                if raw is None: return
+                update = types.Update.de_json(raw.decode("utf-8"))
+                accepted = self.ingestor.submit(update) if update else True  # never re-forwarded, so views that disagree cannot loop
+                self.received += 1
+                conn.sendall(b"\x01" if accepted else b"\x00")
+
+    # --- Handoff ---
+    def _maintain(self):
+        time.sleep(CLUSTER_JOIN_GRACE + self.refresh)  # let a cold start settle before adopting games
+        while True:
+            try:
+                members = self._scan(prune=True)
+                self._members, self._members_at = members, time.monotonic()
+                changed = members != self._balanced
+                self._balanced = members
+                self._rebalance(changed)
+            except Exception as e:
+                print(f"Cluster maintenance failed: {e!r}")
+            time.sleep(self.refresh * 4)
+
+    def _rebalance(self, changed: bool):
+        """Hands over the chats that now belong to another worker and adopts the running rounds that moved here."""
+        moved = [chat_id for chat_id in list(self._leases) if self.owner(chat_id) != self.name]
+        if moved:
+            for chat_id in moved: sessions.discard(chat_id)
+            if store: store.flush()  # the new owner reads the journal as soon as the lease is free
+            for chat_id in moved: self._release(chat_id)
+        if store is None: return
+        candidates = store.active_chat_ids() if changed else list(self._unadopted)
+        self._unadopted = set()
+        for chat_id in candidates:
+            if self.owner(chat_id) != self.name or sessions.get(chat_id, create=False): continue
+            if self.lease(chat_id): sessions.get(chat_id)
+            else: self._unadopted.add(chat_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"worker": self.name, "members": len(self._members), "forwarded": self.forwarded, "received": self.received,
+                "forward_errors": self.forward_errors, "leases": len(self._leases), "lease_timeouts": self.lease_timeouts}
+
+cluster = Cluster(CLUSTER_DIR, ingestor) if CLUSTER_DIR else None
+if cluster: sessions.on_player_change, ingestor.route = cluster.set_player, cluster.route
+
 @app.route(WEBHOOK_PATH, methods=['POST'])
+@instrumented("webhook")
 def webhook():
-    """Processes updates from Telegram."""
+    """Validates and queues updates from Telegram; handlers run on the ingestor workers of the chat's owner."""
     if flask.request.headers.get('content-type') == 'application/json':
-        json_string = flask.request.get_data().decode('utf-8')
-        update = telebot.types.Update.de_json(json_string)
-        if update:
-            bot.process_new_updates([update])
+        raw = flask.request.get_data()
+        update = telebot.types.Update.de_json(raw.decode('utf-8'))
+        if update and not (cluster.submit(update, raw) if cluster else ingestor.submit(update)):
+            return 'busy', 503  # Telegram redelivers later
         return '', 200
     else:
         flask.abort(403)
 
-# This block runs once when Gunicorn starts the app on Replit
-if 'REPL_ID' in os.environ:
-    print("Replit environment detected...")
-    if WEBHOOK_URL:
-        print(f"✅ Public URL found in Secrets: {WEBHOOK_URL}")
-        print("⚙️  Setting webhook...")
+metrics.gauge("alias_sessions", "Chat sessions held in memory.", fn=lambda: sessions.counts()[0])
+metrics.gauge("alias_active_games", "Games in progress.", fn=lambda: sessions.counts()[1])
+metrics.gauge("alias_active_rounds", "Rounds in progress.", fn=lambda: sessions.counts()[2])
+metrics.gauge("alias_threads", "Live threads in this process.", fn=threading.active_count)
+metrics.gauge("alias_timer_jobs", "Round timer jobs waiting to fire.", fn=lambda: timers.stats()["active_timers"])
+metrics.gauge("alias_timer_last_lag_seconds", "Lag of the most recently fired timer job.", fn=lambda: timers.last_lag)
+metrics.gauge("alias_outbox_queue_depth", "Outbound Bot API calls waiting, by priority.", ("priority",),
+              fn=lambda: {(lane,): outbox.stats()[f"queue_{lane}"] for lane in ("high", "normal", "low")})
+metrics.counter("alias_outbox_jobs_total", "Outbound jobs by outcome.", ("outcome",),
+                fn=lambda: {(k,): v for k, v in outbox.stats().items() if not k.startswith("queue_")})
+metrics.gauge("alias_ingest_queue_depth", "Updates waiting for an ingest worker.", fn=lambda: ingestor.stats()["queue_depth"])
+metrics.counter("alias_ingest_updates_total", "Incoming updates by outcome.", ("outcome",),
+                fn=lambda: {(k,): v for k, v in ingestor.stats().items() if k != "queue_depth"})
+metrics.counter("alias_cluster_updates_total", "Updates forwarded to or received from other workers.", ("direction",),
+                fn=lambda: {("forwarded",): cluster.forwarded, ("received",): cluster.received, ("failed",): cluster.forward_errors} if cluster else {})
+metrics.counter("alias_user_cache_lookups_total", "User name lookups by cache result.", ("result",),
+                fn=lambda: {("hit",): users.hits, ("miss",): users.misses})
 
-        bot.remove_webhook()
-        time.sleep(0.5)
-        bot.set_webhook(url=WEBHOOK_URL + WEBHOOK_PATH)
+@app.route("/metrics")
+def metrics_endpoint():
+    return flask.Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
-        print("🚀 Webhook is set successfully! Bot is live.")
-    else:
-        print("⚠️ Could not find WEBHOOK_URL in Secrets. Webhook was not set.")
-        print("   Please go to the 'Secrets' tab and set the WEBHOOK_URL variable.")
+@app.route("/debug/profile")
+def profile_endpoint():
+    """Collapsed stacks from the sampling profiler (PROFILE_INTERVAL); `?reset=1` starts a new window."""
+    if not profiler.interval: return "profiler is off, set PROFILE_INTERVAL", 404
+    profiler.start()
+    return flask.Response(profiler.report(reset=flask.request.args.get("reset") == "1"), mimetype="text/plain")
+
+# --- Startup ---
+WEBHOOK_LOCK_PATH = os.environ.get("WEBHOOK_LOCK_PATH") or os.path.join(
+    tempfile.gettempdir(), f"alias-webhook-{hashlib.blake2b(TOKEN.encode(), digest_size=6).hexdigest()}.lock")
+
+def ensure_webhook(url: str) -> bool:
+    """Points Telegram at `url` unless it already is, one worker at a time; returns whether it had to."""
+    with open(WEBHOOK_LOCK_PATH, "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        with telegram_call("getWebhookInfo"): info = bot.get_webhook_info()
+        if info.url == url: return False
+        with telegram_call("setWebhook"): bot.set_webhook(url=url)
+        return True
+
+class Startup:
+    """Brings a worker up off the request path: indexes, stored games, then the webhook and media pre-warm."""
+    def __init__(self):
+        self.ready = threading.Event()
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def start(self, register_webhook: bool = True):
+        if self._pid == os.getpid(): return
+        with self._lock:
+            if self._pid == os.getpid(): return
+            self.ready = threading.Event()
+            threading.Thread(target=self._run, args=(register_webhook,), name="startup", daemon=True).start()
+            self._pid = os.getpid()
+
+    def _run(self, register_webhook: bool):
+        profiler.start()
+        try:
+            if store: timed_phase("state_db", store.open)
+            if INDEX_LOADING != "lazy":
+                word_bank.load(); media.load()
+                if history: timed_phase("history", history.catch_up)
+            timed_phase("restore", restore_active_games)
+        except Exception as e:
+            print(f"Warm-up failed, continuing cold: {e!r}")
+        startup_phases["ready"] = time.perf_counter() - BOOT_STARTED
+        self.ready.set()
+        print(f"✅ Worker {os.getpid()} ready in {startup_phases['ready']:.2f}s")
+        if register_webhook: self.register_webhook()
+        if MEDIA_STORAGE_CHAT_ID: media.prewarm(int(MEDIA_STORAGE_CHAT_ID))
+
+    @staticmethod
+    def register_webhook():
+        if not WEBHOOK_URL:
+            print("⚠️ Could not find WEBHOOK_URL in Secrets. Webhook was not set.")
+            print("   Please go to the 'Secrets' tab and set the WEBHOOK_URL variable.")
+            return
+        try:
+            changed = timed_phase("webhook", lambda: ensure_webhook(WEBHOOK_URL + WEBHOOK_PATH))
+            print("🚀 Webhook is set successfully! Bot is live." if changed else "🚀 Webhook already set. Bot is live.")
+        except Exception as e:
+            print(f"⚠️ Could not set the webhook: {e!r}")
+
+startup = Startup()
+
+def create_app() -> flask.Flask:
+    """App factory (`gunicorn 'main:create_app()'`): starts this worker's warm-up in the background and returns at once."""
+    startup.start()
+    return app
+
+@app.before_request
+def _start_on_first_request():
+    startup.start()  # plain `gunicorn main:app` still warms up, on the first request
+
+@app.route("/ready")
+def ready_endpoint():
+    """200 once this worker's caches are warm, 503 until then."""
+    ready = startup.ready.is_set()
+    return flask.jsonify(ready=ready, pid=os.getpid(), phases={k: round(v, 4) for k, v in startup_phases.items()}), 200 if ready else 503
+
+metrics.gauge("alias_startup_seconds", "Time spent in each startup phase; `ready` is from import to warm caches.", ("phase",),
+              fn=lambda: {(phase,): seconds for phase, seconds in startup_phases.items()})
+
+startup_phases["import"] = time.perf_counter() - BOOT_STARTED
+
+# On Replit gunicorn serves `main:app`. The webhook has to be set for the first request to arrive, but the
+# warm-up waits for that request: run here, it could land in a --preload master and be lost at the fork.
+if 'REPL_ID' in os.environ:
+    print("Replit environment detected...")
+    threading.Thread(target=Startup.register_webhook, name="webhook", daemon=True).start()
 
 # This part is only for running the Flask server locally.
 if __name__ == "__main__":
     print("Running in local mode. Bot will use polling.")
     bot.remove_webhook()
+    startup.start(register_webhook=False)
     bot.polling(none_stop=True)
@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ.setdefault("STATE_DB_PATH", "")
+os.environ.setdefault("HISTORY_PATH", "")
+os.environ.setdefault("INDEX_LOADING", "lazy")
+
+
+@pytest.fixture(scope="session")
+def bot():
+    """main.py with its word bank loaded; nothing is started and no request reaches Telegram."""
+    cwd = os.getcwd()
+    os.chdir(ROOT)  # WORDS_PATH and DECKS_DIR are relative to the repository
+    try:
+        import main
+        main.word_bank.load()
+    finally:
+        os.chdir(cwd)
+    return main
@@ -0,0 +1,71 @@
+import os
+import random
+
+import pytest
+
+WORDS = ["кіт", "пес", "сонце", "місто", "ріка", "гора", "книга", "стіл", "вікно", "зима", "море", "ліс"]
+
+
+@pytest.fixture
+def small_log(bot, monkeypatch):
+    """Limits small enough that a few hundred rounds go through many checkpoints and compactions."""
+    monkeypatch.setattr(bot, "HISTORY_MAX_BYTES", 6000)
+    monkeypatch.setattr(bot, "HISTORY_KEEP_BYTES", 2000)
+    monkeypatch.setattr(bot, "HISTORY_CHECKPOINT_BYTES", 1000)
+
+
+def rounds(count, seed=1):
+    """(chat, team, player, answers) for `count` rounds; the answers are what record_round receives."""
+    rng = random.Random(seed)
+    for n in range(count):
+        chat_id = -rng.randrange(1, 4)
+        answers = [(1.7e9 + n + i / 10, rng.choice(WORDS), rng.choice((0, 1, 1, 2)), rng.randrange(500, 9000)) for i in range(rng.randrange(1, 6))]
+        yield chat_id, rng.choice(["Коти", "Пси"]), rng.randrange(100, 106), answers
+
+
+def folded(bot, recorded):
+    """The aggregates a single fold of every record gives, with no checkpoint or compaction in between."""
+    reference = bot.GameHistory(os.devnull)
+    for chat_id, team, user_id, answers in recorded:
+        for i, (ts, word, result, ms) in enumerate(answers):
+            reference._fold(ts, chat_id, user_id, result | (bot.ROUND_FIRST if i == 0 else 0), ms, team, word)
+    return aggregates(reference)
+
+
+def aggregates(history):
+    return history.chats, history.players, history.teams, history.words
+
+
+def test_aggregates_survive_checkpoints_and_compaction_across_readers(bot, small_log, tmp_path):
+    path = str(tmp_path / "history.log")
+    writer, reader = bot.GameHistory(path), bot.GameHistory(path)
+    recorded = []
+    for n, played in enumerate(rounds(400)):
+        writer.record_round(*played); recorded.append(played)
+        if n % 7 == 0: writer.maintain()
+        if n % 11 == 0: reader.catch_up()
+    writer.catch_up(); reader.catch_up()
+    assert writer._generation > 2 and os.path.getsize(path) <= bot.HISTORY_MAX_BYTES + 200  # it really compacted, more than once
+    expected = folded(bot, recorded)
+    assert aggregates(writer) == expected
+    assert aggregates(reader) == expected  # reloaded after every generation swap it noticed
+    fresh = bot.GameHistory(path)
+    fresh.catch_up()
+    assert aggregates(fresh) == expected  # a restart: checkpoint plus the tail of the current log
+
+
+def test_a_torn_write_is_skipped_and_reading_resynchronises(bot, small_log, tmp_path):
+    path = str(tmp_path / "history.log")
+    history, reader = bot.GameHistory(path), bot.GameHistory(path)
+    played = list(rounds(20, seed=2))
+    for round_ in played[:10]: history.record_round(*round_)
+    reader.catch_up()
+    chat_id, team, user_id, answers = played[10]
+    history.record_round(chat_id, team, user_id, answers)
+    with open(path, "rb+") as f:  # the writer died part-way through its last record
+        f.truncate(os.path.getsize(path) - 5)
+    reader.catch_up()
+    for round_ in played[11:]: history.record_round(*round_)
+    reader.catch_up()
+    intact = played[:10] + [(chat_id, team, user_id, answers[:-1])] + played[11:]
+    assert aggregates(reader) == folded(bot, intact)
@@ -0,0 +1,77 @@
+import json
+import threading
+import time
+
+import pytest
+from telebot import types
+
+
+class Bot:
+    """Stands in for TeleBot.process_new_updates; a chat listed in `hold` blocks until released."""
+    def __init__(self):
+        self.handled, self.hold = [], {}
+
+    def process_new_updates(self, updates):
+        for update in updates:
+            gate = self.hold.get(update.message.chat.id)
+            if gate is not None: gate.wait(5)
+            self.handled.append((update.message.chat.id, update.message.text))
+
+
+def update_json(update_id, chat_id, text):
+    return {"update_id": update_id, "message": {"message_id": update_id, "date": 0, "text": text,
+                                                 "chat": {"id": chat_id, "type": "group" if chat_id < 0 else "private"}}}
+
+
+def update(update_id, chat_id, text):
+    return types.Update.de_json(update_json(update_id, chat_id, text))
+
+
+def eventually(predicate, timeout=2.0):
+    until = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < until, "timed out"
+        time.sleep(0.005)
+
+
+@pytest.fixture
+def fake():
+    return Bot()
+
+
+def test_a_redelivered_update_is_handled_once(bot, fake):
+    ingestor = bot.UpdateIngestor(fake, workers=2)
+    assert ingestor.submit(update(1, -5, "a")) and ingestor.submit(update(1, -5, "a"))
+    eventually(lambda: ingestor.processed == 1)
+    time.sleep(0.05)
+    assert fake.handled == [(-5, "a")] and ingestor.duplicates == 1
+
+
+def test_a_chat_is_handled_in_order_while_others_proceed(bot, fake):
+    ingestor = bot.UpdateIngestor(fake, workers=4)
+    gate = fake.hold[-5] = threading.Event()
+    for n, (chat_id, text) in enumerate([(-5, "a1"), (-5, "a2"), (-6, "b1"), (-5, "a3")]): ingestor.submit(update(n, chat_id, text))
+    eventually(lambda: (-6, "b1") in fake.handled)
+    assert fake.handled == [(-6, "b1")]
+    gate.set()
+    eventually(lambda: ingestor.processed == 4)
+    assert [text for chat_id, text in fake.handled if chat_id == -5] == ["a1", "a2", "a3"]
+
+
+def test_a_full_queue_answers_503_and_admits_the_redelivery(bot, fake, monkeypatch):
+    monkeypatch.setattr(bot, "INGEST_PUT_TIMEOUT", 0.05)
+    monkeypatch.setattr(bot.startup, "start", lambda *args, **kwargs: None)
+    ingestor = bot.UpdateIngestor(fake, workers=1, queue_size=1)
+    monkeypatch.setattr(bot, "ingestor", ingestor)
+    gate = fake.hold[-5] = threading.Event()
+    ingestor.submit(update(1, -5, "handling"))
+    eventually(lambda: ingestor.stats()["queue_depth"] == 0)  # the worker is stuck on it
+    ingestor.submit(update(2, -5, "queued"))
+    client = bot.app.test_client()
+    post = lambda: client.post(bot.WEBHOOK_PATH, data=json.dumps(update_json(3, -5, "late")), content_type="application/json")
+    assert post().status_code == 503 and ingestor.rejected == 1
+    gate.set()
+    eventually(lambda: ingestor.processed == 2)
+    assert post().status_code == 200  # not mistaken for a duplicate
+    eventually(lambda: ingestor.processed == 3)
+    assert fake.handled == [(-5, "handling"), (-5, "queued"), (-5, "late")] and ingestor.duplicates == 0
@@ -0,0 +1,95 @@
+import threading
+import time
+
+import pytest
+from telebot.apihelper import ApiTelegramException
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class Bot:
+    """Records calls; a chat listed in `hold` blocks until released, a queued error is raised once."""
+    def __init__(self):
+        self.calls, self.hold, self.errors = [], {}, []
+
+    def _call(self, chat_id, text):
+        gate = self.hold.get(chat_id)
+        if gate is not None: gate.wait(5)
+        if self.errors: raise self.errors.pop(0)
+        self.calls.append((chat_id, text))
+        return text
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self._call(chat_id, text)
+
+    def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        return self._call(chat_id, text)
+
+
+def eventually(predicate, timeout=2.0):
+    until = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < until, "timed out"
+        time.sleep(0.005)
+
+
+@pytest.fixture
+def outbox(bot):
+    """An Outbox on a fake bot and a virtual clock; `tick(seconds)` moves the clock and wakes the workers."""
+    clock, fake = Clock(), Bot()
+    box = bot.Outbox(fake, workers=4, clock=clock)
+
+    def tick(seconds):
+        clock.now += seconds
+        with box._cond: box._cond.notify_all()
+    box.fake, box.tick = fake, tick
+    return box
+
+
+def test_a_chat_gets_its_messages_in_order_while_others_go_ahead(bot, outbox):
+    gate = outbox.fake.hold[5] = threading.Event()
+    first, second = outbox.submit("send_message", 5, "a1"), outbox.submit("send_message", 5, "a2")
+    outbox.submit("send_message", 6, "b1").result(2)
+    time.sleep(0.05)
+    assert outbox.fake.calls == [(6, "b1")] and not second.done()
+    gate.set()
+    assert (first.result(2), second.result(2)) == ("a1", "a2")
+    assert outbox.fake.calls == [(6, "b1"), (5, "a1"), (5, "a2")]
+
+
+def test_queued_edits_of_one_message_coalesce_into_the_latest(bot, outbox):
+    gate = outbox.fake.hold[5] = threading.Event()
+    outbox.submit("send_message", 5, "busy")
+    edits = [outbox.submit("edit_message_text", f"{n} сек", chat_id=5, message_id=9, priority=bot.PRIORITY_LOW, coalesce=True) for n in (3, 2, 1)]
+    assert edits[0] is edits[1] is edits[2] and outbox.coalesced == 2
+    gate.set()
+    assert edits[0].result(2) == "1 сек"
+    eventually(lambda: outbox.stats()["queue_depth"] == 0)
+    assert outbox.fake.calls == [(5, "busy"), (5, "1 сек")]
+
+
+def test_a_429_pauses_the_chat_for_retry_after_and_requeues(bot, outbox):
+    outbox.fake.errors.append(ApiTelegramException("sendMessage", None, {"error_code": 429, "description": "Too Many Requests", "parameters": {"retry_after": 5}}))
+    sent = outbox.submit("send_message", 5, "again")
+    eventually(lambda: outbox.retried == 1)
+    outbox.tick(4.9)
+    time.sleep(0.05)
+    assert not sent.done()
+    outbox.tick(0.1)
+    assert sent.result(2) == "again" and outbox.failed == 0
+
+
+def test_cosmetic_updates_keep_the_reserve_and_expire(bot, outbox):
+    countdown = [outbox.submit("send_message", 5, f"tick {n}", priority=bot.PRIORITY_LOW) for n in range(bot.PRIVATE_CHAT_BURST)]
+    kept = bot.PRIVATE_CHAT_BURST - bot.LOW_PRIORITY_RESERVE
+    eventually(lambda: len(outbox.fake.calls) == kept)
+    assert outbox.submit("send_message", 5, "result").result(2) == "result"  # the reserve is there for it
+    outbox.tick(bot.LOW_PRIORITY_TTL + 0.1)
+    assert [future.result(2) for future in countdown[kept:]] == [None] * bot.LOW_PRIORITY_RESERVE
+    assert outbox.dropped == bot.LOW_PRIORITY_RESERVE and len(outbox.fake.calls) == kept + 1
@@ -0,0 +1,129 @@
+import json
+import sqlite3
+
+PLAYERS = {101: "Коти", 102: "Коти", 201: "Пси", 202: "Пси"}
+
+
+def journaled(bot, chat_id):
+    """A session whose events land in the returned list, as GameStore.record would see them."""
+    session, journal = bot.GameSession(chat_id), []
+    session.journal = lambda s, kind, data: journal.append((kind, stored(data)))
+    return session, journal
+
+
+def stored(data):
+    return json.loads(json.dumps(data))
+
+
+def play(session, on_step):
+    """Two rounds of a game, prefetching the next word wherever the handlers do; calls on_step after each event."""
+    session.configure_teams(["Коти", "Пси"]); on_step()
+    session.choose_deck(None); on_step()
+    for user_id, team in PLAYERS.items(): session.join(user_id, team); on_step()
+    session.start_game(seed=42); on_step()
+    for user_id in (101, 201):
+        session.begin_round(user_id, None, 1e12); on_step()
+        session.prefetch_word(); on_step()
+        for correct in (True, False, True):
+            session.score_answer(correct); session.next_word(); session.prefetch_word(); on_step()
+        session.close_round(); on_step()
+        session.advance_turn(); on_step()
+
+
+def replayed(bot, chat_id, events, snapshot=None):
+    session = bot.GameSession(chat_id)
+    if snapshot: session.restore(snapshot)
+    for kind, data in events: session.replay(kind, data)
+    return session
+
+
+def test_replay_deals_like_the_live_game(bot):
+    live, journal = journaled(bot, -1001)
+    play(live, lambda: None)
+    live.begin_round(102, None, 1e12)
+    replay = replayed(bot, -1002, journal[:-1])
+    replay.begin_round(102, None, 1e12)
+    assert stored(replay.to_dict()) == stored(live.to_dict())
+    assert [replay.next_word() for _ in range(20)] == [live.next_word() for _ in range(20)]
+
+
+def test_snapshot_matches_tail_replay(bot):
+    live, journal = journaled(bot, -1003)
+    snapshots = []
+    play(live, lambda: snapshots.append((len(journal), stored(live.to_dict()))))
+    for i, (at, snapshot) in enumerate(snapshots):
+        assert stored(replayed(bot, -2000 - i, journal[:at]).to_dict()) == snapshot, f"snapshot after event {at}"
+    at, snapshot = snapshots[len(snapshots) // 2]
+    assert stored(replayed(bot, -1004, journal[at:], snapshot).to_dict()) == stored(live.to_dict())
+
+
+def test_unreadable_state_resets_the_chat(bot, tmp_path, monkeypatch):
+    store = bot.GameStore(str(tmp_path / "state.db"))
+    monkeypatch.setattr(bot, "store", store)
+    chat_id = -1005
+    live = bot.GameSession(chat_id)
+    live.journal = store.record
+    live.configure_teams(["Коти", "Пси"])
+    live.join(101, "Коти")
+    store.flush()
+    db = sqlite3.connect(store.path)
+    with db: db.execute("INSERT INTO events (chat_id, kind, data) VALUES (?, 'from_a_newer_build', '{}')", (chat_id,))
+    db.close()
+
+    session = bot.sessions.get(chat_id)
+    try:
+        assert session.teams == {} and session.journal == store.record
+        assert store.load(chat_id) is None  # the reset was journaled, so the bad rows are gone
+    finally:
+        bot.sessions.discard(chat_id)
+
+
+def stored_chats(bot, store):
+    """Three chats in `store`: -1101 mid-round, -1102 with only a /setup draft, -1103 after a finished round."""
+    for chat_id in (-1101, -1102, -1103):
+        session = bot.GameSession(chat_id)
+        session.journal = store.record
+        session.draft_setup(7)
+        if chat_id == -1102: continue
+        session.configure_teams(["Коти", "Пси"]); session.join(101, "Коти"); session.choose_deck(None); session.start_game(seed=1)
+        session.begin_round(101, None, 1e12)
+        if chat_id == -1103: session.close_round()
+    store.flush()
+
+
+def test_boot_loads_only_chats_with_a_round_in_progress(bot, tmp_path, monkeypatch):
+    store = bot.GameStore(str(tmp_path / "state.db"))
+    monkeypatch.setattr(bot, "store", store)
+    monkeypatch.setattr(bot, "_start_round_timer", lambda session, state: None)
+    stored_chats(bot, store)
+    try:
+        bot.restore_active_games()
+        assert [chat_id for chat_id in (-1101, -1102, -1103) if bot.sessions.get(chat_id, create=False)] == [-1101]
+        assert bot.sessions.get(-1102).setup_message_id == 7  # the rest still load on their next update
+    finally:
+        for chat_id in (-1101, -1102, -1103): bot.sessions.discard(chat_id)
+
+
+def test_chats_idle_past_the_retention_are_purged(bot, tmp_path, monkeypatch):
+    store = bot.GameStore(str(tmp_path / "state.db"))
+    stored_chats(bot, store)
+    db = sqlite3.connect(store.path)
+    with db: db.execute("UPDATE chats SET updated = updated - ? WHERE chat_id != -1103", (bot.STATE_RETENTION + 60,))
+    store._next_purge = 0
+    session = bot.GameSession(-1103)
+    session.journal = store.record
+    session.draft_setup(8)
+    store.flush()
+    assert store.purged == 2 and store.load(-1101) is None and store.load(-1102) is None
+    assert store.load(-1103) is not None
+    assert db.execute("SELECT COUNT(*) FROM events WHERE chat_id != -1103").fetchone() == (0,)
+    db.close()
+
+
+def test_a_database_without_the_chats_table_is_indexed_on_open(bot, tmp_path):
+    path = str(tmp_path / "state.db")
+    stored_chats(bot, bot.GameStore(path))
+    db = sqlite3.connect(path)
+    with db: db.execute("DROP TABLE chats")
+    db.close()
+    assert bot.GameStore(path).active_chat_ids() == [-1101]
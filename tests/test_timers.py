@@ -0,0 +1,101 @@
+import json
+import os
+import signal
+import time
+
+import pytest
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class Outbox:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, method, *args, **kwargs):
+        self.sent.append((method, kwargs.get("chat_id"), kwargs.get("text") or kwargs.get("caption")))
+
+
+@pytest.fixture
+def round_(bot, monkeypatch):
+    """A running 5-second round on a virtual clock; returns (clock, scheduler, session, state, outbox, ended)."""
+    clock, outbox, ended = Clock(), Outbox(), []
+    timers = bot.TimerScheduler(clock=clock, threaded=False)
+    monkeypatch.setattr(bot, "timers", timers)
+    monkeypatch.setattr(bot, "outbox", outbox)
+    monkeypatch.setattr(bot, "ROUND_TIME", 5)
+    monkeypatch.setattr(bot, "end_round", lambda session, user_id, score: (ended.append(clock.now), session.close_round()))
+    session = bot.GameSession(-3001)
+    session.configure_teams(["Коти", "Пси"]); session.join(101, "Коти")
+    session.choose_deck(None); session.start_game(seed=7)
+    state = session.begin_round(101, None, time.time() + 5)
+    state.player_message_id, session.group_timer_message_id = 11, 12
+    bot._start_round_timer(session, state)
+    return clock, timers, session, state, outbox, ended
+
+
+def advance(clock, timers, seconds, step=0.25):
+    for _ in range(int(seconds / step)):
+        clock.now += step
+        timers.run_pending()
+
+
+def test_round_ends_at_the_deadline_after_one_tick_per_second(round_):
+    clock, timers, session, state, outbox, ended = round_
+    advance(clock, timers, 6)
+    assert ended == [pytest.approx(1005.0, abs=0.25)]
+    group = [text for method, chat_id, text in outbox.sent if chat_id == session.chat_id]
+    assert group == [f"⏳ Залишилось часу: *{left}* сек" for left in (4, 3, 2, 1)]
+    assert sum(1 for _, chat_id, _ in outbox.sent if chat_id == 101) == 4
+    assert timers.stats()["active_timers"] == 0 and session.player is None
+
+
+def test_late_ticks_are_skipped_not_replayed(round_):
+    clock, timers, session, state, outbox, ended = round_
+    clock.now += 3.5  # the executor stalled: the ticks for 1, 2 and 3 seconds are all due at once
+    timers.run_pending()
+    assert [text for _, chat_id, text in outbox.sent if chat_id == session.chat_id] == ["⏳ Залишилось часу: *2* сек"]  # 1.5 s left, not the late tick's own second
+    assert state.tick_job.args[-1] == 4 and timers.stats()["max_lag"] == pytest.approx(2.5, abs=0.01)
+    advance(clock, timers, 2)
+    assert len(ended) == 1
+
+
+def test_stopping_the_timer_between_ticks_cancels_both_jobs(round_):
+    clock, timers, session, state, outbox, ended = round_
+    advance(clock, timers, 1.5)
+    state.stop_timer()
+    advance(clock, timers, 6)
+    assert ended == [] and len(outbox.sent) == 2
+    assert timers.stats()["active_timers"] == 0
+
+
+def test_a_forked_child_runs_its_own_scheduler_and_outbox(bot):
+    class Bot:
+        def send_message(self, chat_id, text, **kwargs):
+            return text
+
+    timers, outbox, fired = bot.TimerScheduler(), bot.Outbox(Bot()), []
+    timers.call_later(0, fired.append, "parent"); outbox.call("send_message", 5, "parent")  # threads started before the fork
+    timers.call_later(0.2, fired.append, "inherited")
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:  # pragma: no cover - reported through the pipe
+        try:
+            signal.alarm(5)  # a child stuck on dead threads dies, and the parent reads nothing
+            timers.call_later(0, fired.append, "child")
+            sent = outbox.submit("send_message", 5, "child").result(timeout=2)
+            time.sleep(0.4)
+            os.write(write, json.dumps([sent, fired]).encode())
+        finally:
+            os._exit(0)
+    os.close(write)
+    with os.fdopen(read) as f: report = f.read()
+    os.waitpid(pid, 0)
+    sent, child_fired = json.loads(report or '[null, []]')
+    assert sent == "child" and sorted(child_fired) == ["child", "inherited", "parent"]
@@ -0,0 +1,121 @@
+import time
+from concurrent.futures import Future
+
+import pytest
+from telebot import types
+from telebot.apihelper import ApiTelegramException
+
+
+class Outbox:
+    """Queues like the real one but never sends; a test resolves each future by hand."""
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, method, *args, **kwargs):
+        future = Future()
+        self.submitted.append((method, kwargs, future))
+        return future
+
+    def send(self, method, *args, **kwargs):
+        return self.submit(method, *args, **kwargs)
+
+    def call(self, method, *args, **kwargs):
+        raise AssertionError(f"{method} waited for Telegram on the click path")
+
+    def discard(self, method, chat_id, message_id):
+        pass
+
+
+class Media:
+    def __init__(self, images):
+        self.images, self.file_ids, self.forgotten = images, {}, []
+
+    def image_path(self, word):
+        return self.images.get(word)
+
+    def file_id(self, word):
+        return self.file_ids.get(word)
+
+    def store(self, word, msg):
+        self.file_ids[word] = msg.photo[-1].file_id
+
+    def forget(self, word):
+        self.forgotten.append(word); self.file_ids.pop(word, None)
+
+
+def photo_message(file_id):
+    return types.Message.de_json({"message_id": 11, "date": 0, "chat": {"id": 101, "type": "private"},
+                                  "photo": [{"file_id": file_id, "file_unique_id": file_id, "width": 1, "height": 1}]})
+
+
+def rejected(description="Bad Request: wrong file identifier"):
+    return ApiTelegramException("editMessageMedia", None, {"error_code": 400, "description": description})
+
+
+@pytest.fixture
+def photo_round(bot, monkeypatch, tmp_path):
+    """A round whose player message is a photo; returns (session, state, outbox, media, timers, picture of `word`)."""
+    outbox, timers = Outbox(), bot.TimerScheduler(threaded=False)
+    monkeypatch.setattr(bot, "outbox", outbox)
+    monkeypatch.setattr(bot, "timers", timers)
+    session = bot.GameSession(-4001)
+    session.configure_teams(["Коти", "Пси"]); session.join(101, "Коти")
+    session.choose_deck(None); session.start_game(seed=3)
+    state = session.begin_round(101, None, time.time() + 60)
+    session.set_player_message(11, "photo")
+    picture = tmp_path / "word.jpg"
+    picture.write_bytes(b"jpeg")
+    media = Media({})
+    monkeypatch.setattr(bot, "media", media)
+    return session, state, outbox, media, timers, str(picture)
+
+
+def next_word(bot, session, media, picture=None):
+    with session.lock:
+        word = session.next_word()
+        if picture: media.images[word] = picture
+        bot.send_word_to_player(session)
+    return word
+
+
+def test_photo_words_are_edited_without_waiting_and_uploads_are_remembered(bot, photo_round):
+    session, state, outbox, media, timers, picture = photo_round
+    word = next_word(bot, session, media, picture)
+    method, kwargs, future = outbox.submitted[-1]
+    assert method == "edit_message_media" and kwargs["media"].media == b"jpeg"
+    future.set_result(photo_message("uploaded"))
+    timers.run_pending()
+    assert media.file_ids == {word: "uploaded"}
+
+
+def test_a_rejected_file_id_is_forgotten_and_uploaded_again(bot, photo_round):
+    session, state, outbox, media, timers, picture = photo_round
+    with session.lock: word = session.next_word()
+    media.images[word], media.file_ids[word] = picture, "stale"
+    with session.lock: bot.send_word_to_player(session)
+    assert outbox.submitted[-1][1]["media"].media == "stale"
+    outbox.submitted[-1][2].set_exception(rejected())
+    timers.run_pending()
+    assert media.forgotten == [word] and outbox.submitted[-1][1]["media"].media == b"jpeg"
+    assert session.player is state
+
+
+def test_a_late_result_for_an_older_word_is_ignored(bot, photo_round):
+    session, state, outbox, media, timers, picture = photo_round
+    next_word(bot, session, media, picture)
+    first = outbox.submitted[-1][2]
+    next_word(bot, session, media, picture)
+    first.set_exception(rejected())
+    timers.run_pending()
+    assert session.player is state and media.forgotten == []
+
+
+def test_a_word_without_a_picture_replaces_the_caption_of_a_photo(bot, photo_round):
+    session, state, outbox, media, timers, picture = photo_round
+    word = next_word(bot, session, media)
+    method, kwargs, future = outbox.submitted[-1]
+    assert method == "edit_message_caption" and word.upper() in kwargs["caption"]
+    assert state.message_type == "photo"
+    future.set_result(True)
+    timers.run_pending()
+    assert session.player is state